@@ -1,6 +1,11 @@
 # Copyright (c) 2019 Pietro Astolfi, Emanuele Olivetti
 # MIT License
 
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+import hashlib
+import mmap
+import os
 import numpy as np
 import nibabel as nib
 from struct import unpack
@@ -32,51 +37,18 @@ def get_length_from_bytes(f, nb_bytes_int32=4, byteorder='little'):
     return int.from_bytes(f.read(nb_bytes_int32), byteorder=byteorder)
 
 
-def load_streamlines(trk_fn, idxs=None, apply_affine=True,
-                     container='list', replace=False, verbose=False):
-    """Load streamlines from a .trk file. If a list of indices (idxs) is
-    given, this function just loads and returns the requested
-    streamlines, skipping all the non-requested ones.
+def compute_index_loop(trk_fn, header_size, nb_streamlines, n_scalars=0,
+                       n_properties=0):
+    """Parse the lengths of all streamlines of a .trk file, one at a
+    time, by jumping from one length field to the next with seek().
 
-    This function is sort of similar to nibabel.streamlines.load() but
-    extremely FASTER. It is very convenient if you need to load only
-    some streamlines in large tractograms. Like 100x faster than what
-    you can get with nibabel.
+    Return the lengths and the position in bytes of the coordinates of
+    each streamline in the file.
     """
-
-    if verbose:
-        print("Loading %s" % trk_fn)
-
-    lazy_trk = nib.streamlines.load(trk_fn, lazy_load=True)
-    header = lazy_trk.header
-    header_size = header['hdr_size']
-    nb_streamlines = header['nb_streamlines']
-    n_scalars = header['nb_scalars_per_point']
-    n_properties = header['nb_properties_per_streamline']
-
-    if idxs is None:
-        idxs = np.arange(nb_streamlines, dtype=np.int)
-    elif isinstance(idxs, int):
-        if verbose:
-            print('Sampling %s streamlines uniformly at random' % idxs)
-
-        if idxs > nb_streamlines and (not replace):
-            print('WARNING: Sampling with replacement')
-
-        idxs = np.random.choice(np.arange(nb_streamlines), idxs,
-                                replace=replace)
-
-    ## See: http://www.trackvis.org/docs/?subsect=fileformat
-    length_bytes = 4
-    point_size = 3 + n_scalars
-    point_bytes = 4 * point_size
+    point_bytes = 4 * (3 + n_scalars)
     properties_bytes = n_properties * 4
 
-    if verbose:
-        print("Parsing lenghts of %s streamlines" % nb_streamlines)
-        t0 = time()
-
-    lengths = np.empty(nb_streamlines, dtype=np.int)
+    lengths = np.empty(nb_streamlines, dtype=np.int64)
 
     get_length = get_length_struct
     # In order to reduce the 20x increase in time when reading small
@@ -96,51 +68,524 @@ def load_streamlines(trk_fn, idxs=None, apply_affine=True,
             jump = point_bytes * l + properties_bytes
             f.seek(jump, 1)
 
-    if verbose:
-        print("%s sec." % (time() - t0))
+    return lengths, _compute_index_bytes(lengths, header_size, n_scalars,
+                                         n_properties)
+
+
+def compute_index_mmap(trk_fn, header_size, nb_streamlines, n_scalars=0,
+                       n_properties=0):
+    """Parse the lengths of all streamlines of a .trk file through a
+    memory map of the body of the file.
+
+    Every record of a .trk file (length, coordinates, scalars and
+    properties) is made of 4-byte words, so the body is viewed as a
+    single int32 buffer. The chain of lengths is still inherently
+    sequential, but following it is reduced to integer indexing in the
+    mapped buffer instead of one read() and one seek() per streamline,
+    and the byte index is then derived with NumPy in one pass.
+
+    Return the same lengths and byte index as compute_index_loop().
+    """
+    if sys.byteorder != 'little':
+        # The buffer is read with the native int32, .trk are little-endian
+        return compute_index_loop(trk_fn, header_size, nb_streamlines,
+                                  n_scalars=n_scalars,
+                                  n_properties=n_properties)
+
+    point_size = 3 + n_scalars
+    lengths = [0] * nb_streamlines
+
+    with open(trk_fn, 'rb') as f:
+        file_size = os.fstat(f.fileno()).st_size
+        nb_words = (file_size - header_size) // 4
+        if nb_streamlines == 0 or nb_words <= 0:
+            return _compute_index_from_list([], header_size, n_scalars,
+                                            n_properties)
+        body = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+
+    words = memoryview(body)[header_size:header_size + nb_words * 4].cast('i')
+    record_skip = 1 + n_properties
+    try:
+        pos = 0
+        for idx in range(nb_streamlines):
+            l = words[pos]
+            lengths[idx] = l
+            pos += record_skip + l * point_size
+    except IndexError:
+        raise ValueError('The .trk file is shorter than announced by its '
+                         'header ({} streamlines).'.format(nb_streamlines))
+    finally:
+        words.release()
+        body.close()
+
+    return _compute_index_from_list(lengths, header_size, n_scalars,
+                                    n_properties)
+
+
+def _compute_index_from_list(lengths, header_size, n_scalars, n_properties):
+    """Convert a list of lengths to the arrays returned by the index
+    engines."""
+    lengths = np.array(lengths, dtype=np.int64)
+    return lengths, _compute_index_bytes(lengths, header_size, n_scalars,
+                                         n_properties)
+
+
+def _compute_index_bytes(lengths, header_size, n_scalars, n_properties):
+    """Position in bytes where to find the coordinates of each streamline
+    in the TRK file, from the lengths of all streamlines."""
+    ## See: http://www.trackvis.org/docs/?subsect=fileformat
+    length_bytes = 4
+    point_bytes = 4 * (3 + n_scalars)
+    properties_bytes = n_properties * 4
+
+    if len(lengths) == 0:
+        return np.empty(0, dtype=np.int64)
 
-    # position in bytes where to find a given streamline in the TRK file:
     index_bytes = lengths * point_bytes + properties_bytes + length_bytes
     index_bytes = np.concatenate([[length_bytes], index_bytes[:-1]]).cumsum() + header_size
+
+    return index_bytes
+
+
+INDEX_ENGINES = {'loop': compute_index_loop,
+                 'mmap': compute_index_mmap}
+
+# Number of .trk indices (lengths and byte offsets) kept in memory
+INDEX_CACHE_SIZE = 4
+_index_cache = OrderedDict()
+
+
+def clear_index_cache():
+    """Empty the in-process cache of .trk indices."""
+    _index_cache.clear()
+
+
+def get_sidecar_filename(trk_fn):
+    """Filename of the on-disk index stored next to a .trk file."""
+    return trk_fn + '.idx.npz'
+
+
+def _get_index_key(trk_fn, header_size):
+    """Identify a .trk file by its path, size, mtime and a hash of its
+    header, any change to the file invalidates the cached index."""
+    stat = os.stat(trk_fn)
+    with open(trk_fn, 'rb') as f:
+        header_hash = hashlib.sha1(f.read(header_size)).hexdigest()
+
+    return (os.path.abspath(trk_fn), stat.st_size, stat.st_mtime_ns,
+            header_hash)
+
+
+def _load_sidecar(trk_fn, key):
+    """Read the index sidecar of a .trk file, None if missing or stale."""
+    sidecar_fn = get_sidecar_filename(trk_fn)
+    if not os.path.isfile(sidecar_fn):
+        return None
+
+    try:
+        with np.load(sidecar_fn) as sidecar:
+            if sidecar['size'] != key[1] or sidecar['mtime_ns'] != key[2] \
+                    or str(sidecar['header_hash']) != key[3]:
+                return None
+            return sidecar['lengths'], sidecar['index_bytes']
+    except (OSError, ValueError, KeyError):
+        print('WARNING: Invalid index sidecar %s, ignoring it' % sidecar_fn)
+        return None
+
+
+def _save_sidecar(trk_fn, key, lengths, index_bytes):
+    """Write the index sidecar of a .trk file (atomically)."""
+    sidecar_fn = get_sidecar_filename(trk_fn)
+    tmp_fn = '{}.{}.tmp'.format(sidecar_fn, os.getpid())
+    try:
+        with open(tmp_fn, 'wb') as f:
+            np.savez(f, lengths=lengths, index_bytes=index_bytes,
+                     size=key[1], mtime_ns=key[2], header_hash=key[3])
+        os.replace(tmp_fn, sidecar_fn)
+    except OSError:
+        print('WARNING: Cannot write index sidecar %s' % sidecar_fn)
+        if os.path.isfile(tmp_fn):
+            os.remove(tmp_fn)
+
+
+def get_index(trk_fn, header_size, nb_streamlines, n_scalars=0,
+              n_properties=0, index_engine='mmap', sidecar=False):
+    """Return the lengths and byte index of a .trk file, reusing a
+    previous scan when possible.
+
+    Indices are kept in an in-process LRU cache (of INDEX_CACHE_SIZE
+    files). If sidecar is True, the index is also stored on disk next to
+    the .trk file (see get_sidecar_filename) and reused by later
+    processes. Both are keyed on the size, mtime and header hash of the
+    file, so a modified file is always scanned again.
+    """
+    key = _get_index_key(trk_fn, header_size)
+    if key in _index_cache:
+        _index_cache.move_to_end(key)
+        return _index_cache[key]
+
+    index = _load_sidecar(trk_fn, key) if sidecar else None
+    if index is None:
+        index = INDEX_ENGINES[index_engine](trk_fn, header_size,
+                                            nb_streamlines, n_scalars,
+                                            n_properties)
+        if sidecar:
+            _save_sidecar(trk_fn, key, *index)
+
+    if INDEX_CACHE_SIZE > 0:
+        _index_cache[key] = index
+        while len(_index_cache) > INDEX_CACHE_SIZE:
+            _index_cache.popitem(last=False)
+
+    return index
+
+
+def benchmark_index(trk_fn, engines=('loop', 'mmap'), repeat=3):
+    """Compare the index engines on a .trk file. Check that they return the
+    same lengths and byte index and print the best time of each engine.
+
+    Return a dictionary with the best time (in seconds) of each engine.
+    """
+    header = nib.streamlines.load(trk_fn, lazy_load=True).header
+    args = (trk_fn, header['hdr_size'], header['nb_streamlines'],
+            header['nb_scalars_per_point'],
+            header['nb_properties_per_streamline'])
+
+    timings = {}
+    reference = None
+    for engine in engines:
+        best = None
+        for _ in range(repeat):
+            t0 = time()
+            lengths, index_bytes = INDEX_ENGINES[engine](*args)
+            elapsed = time() - t0
+            best = elapsed if best is None else min(best, elapsed)
+        timings[engine] = best
+
+        if reference is None:
+            reference = lengths, index_bytes
+        elif not (np.array_equal(reference[0], lengths) and
+                  np.array_equal(reference[1], index_bytes)):
+            raise ValueError('Index engine {} does not match {}.'.format(
+                engine, engines[0]))
+        print("%s: %s sec. (%s streamlines)" % (engine, best, args[2]))
+
+    return timings
+
+
+def _allocate_flat(lengths, idxs):
+    """Preallocate the flat (nb_points, 3) buffer of the requested
+    streamlines and the offset of each of them in it."""
+    sel_lengths = lengths[idxs]
+    offsets = np.concatenate([[0], np.cumsum(sel_lengths)]).astype(np.int64)
+
+    return np.empty((offsets[-1], 3), dtype=np.float32), offsets
+
+
+def extract_streamlines_seek(trk_fn, idxs, lengths, index_bytes, n_scalars=0):
+    """Read the requested streamlines of a .trk file one at a time, in
+    the order of idxs, with one seek() and one read per streamline.
+
+    Return the coordinates of all streamlines, concatenated in a single
+    flat (nb_points, 3) array.
+    """
+    point_size = 3 + n_scalars
     # n_floats = lengths * point_size + n_properties
     n_floats = lengths * point_size  # better because it skips properties, if they exist
 
-    if verbose:
-        print("Extracting %s streamlines with the desired id" % len(idxs))
-        t0 = time()
-
-    streamlines = []
+    flat, offsets = _allocate_flat(lengths, idxs)
     with open(trk_fn, 'rb') as f:
-        for idx in idxs:
+        for i, idx in enumerate(idxs):
             # move to the position initial position of the coordinates
             # of the streamline:
             f.seek(index_bytes[idx])
-            # Parse the floats:
+            if n_scalars == 0:
+                f.readinto(flat[offsets[i]:offsets[i + 1]])
+                continue
+            # Parse the floats and remove scalars:
             s = np.fromfile(f, np.float32, n_floats[idx])
-            s.resize(lengths[idx], point_size)
-            # remove scalars if present:
-            if n_scalars > 0:
-                s = s[:, :3]
+            flat[offsets[i]:offsets[i + 1]] = s.reshape(lengths[idx],
+                                                        point_size)[:, :3]
+
+    return flat
+
+
+def _coalesce_ranges(starts, ends, max_gap):
+    """Group sorted byte ranges into runs, a new run starts when the gap
+    with the previous range is larger than max_gap (in bytes).
+
+    Return the index of the first range of each run and the byte range
+    covered by each run.
+    """
+    if len(starts) == 0:
+        empty = np.empty(0, dtype=np.int64)
+        return empty, empty, empty
+
+    # Ranges are sorted and never overlap (except duplicates), the
+    # previous end is the furthest byte read so far
+    gaps = starts[1:] - np.maximum.accumulate(ends)[:-1]
+    run_first = np.concatenate([[0], np.flatnonzero(gaps > max_gap) + 1])
+
+    run_starts = starts[run_first]
+    run_ends = np.maximum.reduceat(ends, run_first)
+
+    return run_first, run_starts, run_ends
+
 
-            streamlines.append(s)
+def extract_streamlines_coalesced(trk_fn, idxs, lengths, index_bytes,
+                                  n_scalars=0, max_gap=65536):
+    """Read the requested streamlines of a .trk file with a few large
+    reads instead of one read per streamline.
 
+    The requested byte ranges are sorted by position in the file and
+    merged when they are adjacent or separated by at most max_gap bytes
+    (the over-read is discarded). The streamlines are then sliced out of
+    these buffers and returned in the original order of idxs. A larger
+    max_gap means less reads but more unused bytes read, which is
+    usually a good trade on network filesystems.
+
+    Return the same flat (nb_points, 3) array as extract_streamlines_seek.
+    """
+    point_size = 3 + n_scalars
+    idxs = np.asarray(idxs, dtype=np.int64)
+    sel_lengths = lengths[idxs]
+    starts = index_bytes[idxs]
+    order = np.argsort(starts, kind='stable')
+    starts = starts[order]
+    ends = starts + sel_lengths[order] * point_size * 4
+
+    run_first, run_starts, run_ends = _coalesce_ranges(starts, ends, max_gap)
+    run_bounds = np.append(run_first, len(starts))
+
+    flat, offsets = _allocate_flat(lengths, idxs)
+    with open(trk_fn, 'rb') as f:
+        for run, (run_start, run_end) in enumerate(zip(run_starts,
+                                                       run_ends)):
+            f.seek(run_start)
+            buf = np.fromfile(f, np.float32, (run_end - run_start) // 4)
+            for i in range(run_bounds[run], run_bounds[run + 1]):
+                pos = order[i]
+                first = (starts[i] - run_start) // 4
+                s = buf[first:first + sel_lengths[pos] * point_size]
+                # remove scalars if present:
+                flat[offsets[pos]:offsets[pos + 1]] = \
+                    s.reshape(sel_lengths[pos], point_size)[:, :3]
+
+    return flat
+
+
+def _pread_into(fd, buf, offset):
+    """Fill buf with the bytes of fd starting at offset (positional read,
+    the file position is not used so fd can be shared between threads)."""
+    buf = memoryview(buf).cast('B')
+    while len(buf):
+        if hasattr(os, 'preadv'):
+            nb_bytes = os.preadv(fd, [buf], offset)
+        else:
+            data = os.pread(fd, len(buf), offset)
+            nb_bytes = len(data)
+            buf[:nb_bytes] = data
+        if nb_bytes == 0:
+            raise ValueError('Unexpected end of file.')
+        buf = buf[nb_bytes:]
+        offset += nb_bytes
+
+
+def extract_streamlines_parallel(trk_fn, idxs, lengths, index_bytes,
+                                 n_scalars=0, nb_threads=None):
+    """Read the requested streamlines of a .trk file from a pool of
+    nb_threads threads (default: os.cpu_count()).
+
+    Every streamline is an independent byte range, read with a positional
+    read on a file descriptor shared by all threads directly into its
+    place in the preallocated output. The reads release the GIL, so
+    several requests are in flight at the same time, which helps on SSD
+    and network filesystems.
+
+    Return the same flat (nb_points, 3) array as extract_streamlines_seek.
+    """
+    if nb_threads is None:
+        nb_threads = os.cpu_count() or 1
+    point_size = 3 + n_scalars
+    idxs = np.asarray(idxs, dtype=np.int64)
+    sel_lengths = lengths[idxs]
+    starts = index_bytes[idxs]
+
+    flat, offsets = _allocate_flat(lengths, idxs)
+
+    def _read_chunk(fd, chunk):
+        for i in chunk:
+            out = flat[offsets[i]:offsets[i + 1]]
+            if n_scalars == 0:
+                _pread_into(fd, out, int(starts[i]))
+                continue
+            # Read the scalars along with the coordinates, then drop them
+            s = np.empty((sel_lengths[i], point_size), dtype=np.float32)
+            _pread_into(fd, s, int(starts[i]))
+            out[:] = s[:, :3]
+
+    # A few chunks per thread balance streamlines of different lengths
+    chunks = np.array_split(np.arange(len(idxs)),
+                            max(1, min(len(idxs), nb_threads * 4)))
+    fd = os.open(trk_fn, os.O_RDONLY | getattr(os, 'O_BINARY', 0))
+    try:
+        with ThreadPoolExecutor(max_workers=nb_threads) as executor:
+            for future in [executor.submit(_read_chunk, fd, chunk)
+                           for chunk in chunks]:
+                future.result()
+    finally:
+        os.close(fd)
+
+    return flat
+
+
+def split_flat_streamlines(flat, lengths, container='list'):
+    """Convert a flat (nb_points, 3) array of concatenated streamlines to
+    the requested container, without copying the coordinates: 'list'
+    and 'array' (of objects) hold views of flat, 'ArraySequence' uses
+    flat as its data and 'array_flat' is flat itself.
+    """
+    if container == 'array_flat':
+        return flat
+
+    lengths = np.asarray(lengths, dtype=np.int64)
+    offsets = np.cumsum(lengths) - lengths
+    if container == 'ArraySequence':
+        streamlines = nib.streamlines.ArraySequence()
+        streamlines._data = flat
+        streamlines._offsets = offsets
+        streamlines._lengths = lengths
+        return streamlines
+
+    views = [flat[offset:offset + length]
+             for offset, length in zip(offsets, lengths)]
+    if container == 'list':
+        return views
+    elif container == 'array':
+        streamlines = np.empty(len(views), dtype=object)
+        for i, s in enumerate(views):
+            streamlines[i] = s
+        return streamlines
+    else:
+        raise ValueError('Unknown container: {}'.format(container))
+
+
+EXTRACTION_MODES = {'seek': extract_streamlines_seek,
+                    'coalesced': extract_streamlines_coalesced,
+                    'parallel': extract_streamlines_parallel}
+
+
+def read_trk_records(trk_fn, start, end, lengths, index_bytes, n_scalars=0,
+                     n_properties=0):
+    """Read the consecutive streamlines [start, end) of a .trk file with a
+    single read, including their scalars and properties.
+
+    Return the points (nb_points, 3), the scalars (nb_points, n_scalars)
+    and the properties (end - start, n_properties) as float32 arrays. No
+    affine is applied.
+    """
+    point_size = 3 + n_scalars
+    sel_lengths = lengths[start:end]
+    nb_points = int(np.sum(sel_lengths))
+    if end <= start:
+        return np.empty((0, 3), dtype=np.float32), \
+            np.empty((0, n_scalars), dtype=np.float32), \
+            np.empty((0, n_properties), dtype=np.float32)
+
+    first_byte = index_bytes[start]
+    last_byte = index_bytes[end - 1] \
+        + (sel_lengths[-1] * point_size + n_properties) * 4
+    with open(trk_fn, 'rb') as f:
+        f.seek(first_byte)
+        buf = np.fromfile(f, np.float32, (last_byte - first_byte) // 4)
+
+    # Position (in words) of the first coordinate of each streamline and
+    # of each point in the buffer
+    records = (index_bytes[start:end] - first_byte) // 4
+    offsets = np.cumsum(sel_lengths) - sel_lengths
+    point_rank = np.arange(nb_points) - np.repeat(offsets, sel_lengths)
+    points_words = np.repeat(records, sel_lengths) + point_rank * point_size
+
+    points = buf[points_words[:, None] + np.arange(point_size)]
+    properties = buf[(records + sel_lengths * point_size)[:, None]
+                     + np.arange(n_properties)]
+
+    return points[:, :3], points[:, 3:], properties
+
+
+def _prepare_load(trk_fn, idxs=None, replace=False, verbose=False,
+                  index_engine='mmap', index_cache=True, sidecar=False):
+    """Read the header and the byte index of a .trk file, and resolve the
+    indices of the streamlines to load (see load_streamlines)."""
+    if index_engine not in INDEX_ENGINES:
+        raise ValueError('Unknown index engine: {}'.format(index_engine))
+
+    if verbose:
+        print("Loading %s" % trk_fn)
+
+    lazy_trk = nib.streamlines.load(trk_fn, lazy_load=True)
+    header = lazy_trk.header
+    header_size = header['hdr_size']
+    nb_streamlines = header['nb_streamlines']
+    n_scalars = header['nb_scalars_per_point']
+    n_properties = header['nb_properties_per_streamline']
+
+    if idxs is None:
+        idxs = np.arange(nb_streamlines, dtype=np.int)
+    elif isinstance(idxs, int):
         if verbose:
-            print("%s sec." % (time() - t0))
+            print('Sampling %s streamlines uniformly at random' % idxs)
+
+        if idxs > nb_streamlines and (not replace):
+            print('WARNING: Sampling with replacement')
+
+        idxs = np.random.choice(np.arange(nb_streamlines), idxs,
+                                replace=replace)
 
     if verbose:
-        print("Converting all streamlines to the container %s" % container)
+        print("Parsing lenghts of %s streamlines (%s engine)" % (
+            nb_streamlines, index_engine))
+        t0 = time()
+
+    if index_cache:
+        lengths, index_bytes = get_index(trk_fn, header_size,
+                                         nb_streamlines, n_scalars,
+                                         n_properties,
+                                         index_engine=index_engine,
+                                         sidecar=sidecar)
+    else:
+        lengths, index_bytes = INDEX_ENGINES[index_engine](
+            trk_fn, header_size, nb_streamlines, n_scalars, n_properties)
+
+    if verbose:
+        print("%s sec." % (time() - t0))
+
+    return header, idxs, lengths, index_bytes
+
+
+def _read_flat(trk_fn, header, idxs, lengths, index_bytes, apply_affine=True,
+               extraction='seek', max_gap=65536, nb_threads=None,
+               verbose=False):
+    """Read the requested streamlines in a flat (nb_points, 3) array, with
+    the affine applied in a single vectorized pass."""
+    n_scalars = header['nb_scalars_per_point']
+
+    if verbose:
+        print("Extracting %s streamlines with the desired id (%s)" % (
+            len(idxs), extraction))
         t0 = time()
 
-    if container == 'array':
-        streamlines = np.array(streamlines, dtype=np.object)
-    elif container == 'ArraySequence':
-        streamlines = nib.streamlines.ArraySequence(streamlines)
-    elif container == 'list':
-        pass
-    elif container == 'array_flat':
-        streamlines = np.concatenate(streamlines, axis=0)
+    if extraction == 'coalesced':
+        streamlines = extract_streamlines_coalesced(trk_fn, idxs, lengths,
+                                                    index_bytes, n_scalars,
+                                                    max_gap=max_gap)
+    elif extraction == 'parallel':
+        streamlines = extract_streamlines_parallel(trk_fn, idxs, lengths,
+                                                   index_bytes, n_scalars,
+                                                   nb_threads=nb_threads)
     else:
-        raise Exception
+        streamlines = extract_streamlines_seek(trk_fn, idxs, lengths,
+                                               index_bytes, n_scalars)
 
     if verbose:
         print("%s sec." % (time() - t0))
@@ -150,14 +595,145 @@ def load_streamlines(trk_fn, idxs=None, apply_affine=True,
             print("Applying affine transformation to streamlines")
             t0 = time()
 
-        aff = nib.streamlines.trk.get_affine_trackvis_to_rasmm(lazy_trk.header)
-        if container == 'array_flat':
-            streamlines = nib.affines.apply_affine(aff, streamlines)
-        else:
-            streamlines = [nib.affines.apply_affine(aff, s) for s in streamlines]
+        # A single vectorized transformation of all points, whatever the
+        # container
+        aff = nib.streamlines.trk.get_affine_trackvis_to_rasmm(header)
+        streamlines = nib.affines.apply_affine(aff, streamlines)
 
         if verbose:
             print("%s sec." % (time() - t0))
 
+    return streamlines
+
+
+def load_streamlines(trk_fn, idxs=None, apply_affine=True,
+                     container='list', replace=False, verbose=False,
+                     index_engine='mmap', index_cache=True, sidecar=False,
+                     extraction='seek', max_gap=65536, nb_threads=None):
+    """Load streamlines from a .trk file. If a list of indices (idxs) is
+    given, this function just loads and returns the requested
+    streamlines, skipping all the non-requested ones.
+
+    This function is sort of similar to nibabel.streamlines.load() but
+    extremely FASTER. It is very convenient if you need to load only
+    some streamlines in large tractograms. Like 100x faster than what
+    you can get with nibabel.
+
+    The byte index of the streamlines is built by index_engine, either
+    'mmap' (default, see compute_index_mmap) or 'loop' (see
+    compute_index_loop). If index_cache is True, the index is reused
+    between calls on the same unmodified file and, if sidecar is True,
+    between processes through a file next to the .trk (see get_index).
+
+    The requested streamlines are read by extraction, either 'seek'
+    (default, one read per streamline), 'coalesced' (a few large reads
+    merging ranges closer than max_gap bytes, see
+    extract_streamlines_coalesced) or 'parallel' (positional reads from
+    nb_threads threads, see extract_streamlines_parallel).
+
+    Whatever the container, the coordinates are read into a single flat
+    buffer, transformed in one pass if apply_affine is True, and split
+    into views (see split_flat_streamlines).
+    """
+    if extraction not in EXTRACTION_MODES:
+        raise ValueError('Unknown extraction mode: {}'.format(extraction))
+    if container not in ['list', 'array', 'ArraySequence', 'array_flat']:
+        raise ValueError('Unknown container: {}'.format(container))
+
+    header, idxs, lengths, index_bytes = _prepare_load(
+        trk_fn, idxs=idxs, replace=replace, verbose=verbose,
+        index_engine=index_engine, index_cache=index_cache, sidecar=sidecar)
+
+    streamlines = _read_flat(trk_fn, header, idxs, lengths, index_bytes,
+                             apply_affine=apply_affine, extraction=extraction,
+                             max_gap=max_gap, nb_threads=nb_threads,
+                             verbose=verbose)
+
+    if verbose:
+        print("Converting all streamlines to the container %s" % container)
+        t0 = time()
+
+    streamlines = split_flat_streamlines(streamlines, lengths[idxs],
+                                         container=container)
+
+    if verbose:
+        print("%s sec." % (time() - t0))
+
     return streamlines, header, lengths[idxs], idxs
 
+
+def iter_streamlines(trk_fn, idxs=None, batch_size=10000, apply_affine=True,
+                     container='list', replace=False, verbose=False,
+                     index_engine='mmap', index_cache=True, sidecar=False,
+                     extraction='seek', max_gap=65536, nb_threads=None):
+    """Generator version of load_streamlines(). The requested streamlines
+    are read, transformed and yielded in batches of (at most) batch_size
+    streamlines, so that the memory used does not depend on the size of
+    the tractogram (apart from its index, see get_index).
+
+    Yield the streamlines of the batch in the requested container, their
+    lengths and their indices.
+    """
+    if extraction not in EXTRACTION_MODES:
+        raise ValueError('Unknown extraction mode: {}'.format(extraction))
+    if container not in ['list', 'array', 'ArraySequence', 'array_flat']:
+        raise ValueError('Unknown container: {}'.format(container))
+    if batch_size < 1:
+        raise ValueError('The batch size must be strictly positive.')
+
+    header, idxs, lengths, index_bytes = _prepare_load(
+        trk_fn, idxs=idxs, replace=replace, verbose=verbose,
+        index_engine=index_engine, index_cache=index_cache, sidecar=sidecar)
+
+    for start in range(0, len(idxs), batch_size):
+        batch_idxs = idxs[start:start + batch_size]
+        streamlines = _read_flat(trk_fn, header, batch_idxs, lengths,
+                                 index_bytes, apply_affine=apply_affine,
+                                 extraction=extraction, max_gap=max_gap,
+                                 nb_threads=nb_threads, verbose=verbose)
+        batch_lengths = lengths[batch_idxs]
+
+        yield split_flat_streamlines(streamlines, batch_lengths,
+                                     container=container), \
+            batch_lengths, batch_idxs
+
+
+def group_to_bitmap(group, nb_streamlines):
+    """Pack the membership of nb_streamlines streamlines to a group (array
+    of indices or boolean mask) into a bitmap, one bit per streamline.
+    """
+    group = np.asarray(group)
+    if group.dtype == bool:
+        mask = np.zeros(nb_streamlines, dtype=bool)
+        mask[:len(group)] = group[:nb_streamlines]
+    else:
+        mask = np.zeros(nb_streamlines, dtype=bool)
+        mask[group.astype(np.int64)] = True
+
+    return np.packbits(mask)
+
+
+def bitmap_contains(bitmap, indices):
+    """Membership of the streamlines at indices in a bitmap (boolean array
+    aligned with indices, duplicates and any order are supported).
+    """
+    indices = np.asarray(indices, dtype=np.int64)
+    shifts = (7 - (indices & 7)).astype(np.uint8)
+
+    return ((bitmap[indices >> 3] >> shifts) & 1).astype(bool)
+
+
+def bitmap_to_group(bitmap, nb_streamlines):
+    """Indices (sorted) of the streamlines set in a bitmap."""
+    return np.flatnonzero(np.unpackbits(bitmap, count=nb_streamlines))
+
+
+def bitmap_complement(bitmap, nb_streamlines):
+    """Bitmap of the streamlines not set in a bitmap (padding bits of the
+    last byte stay unset).
+    """
+    complement = np.invert(bitmap)
+    if nb_streamlines % 8:
+        complement[-1] &= np.uint8((0xFF << (8 - nb_streamlines % 8)) & 0xFF)
+
+    return complement
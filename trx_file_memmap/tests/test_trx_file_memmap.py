@@ -0,0 +1,204 @@
+import os
+import zipfile
+
+import nibabel as nib
+import numpy as np
+
+import trx_file_memmap.trx_file_memmap as trx_file_memmap
+from trx_file_memmap.trx_file_memmap import (TrxFile, concatenate_to_file,
+                                             load, save)
+
+
+def _get_tractogram(nb_streamlines=50):
+    """ Random tractogram with dpv and dps, and its reference """
+    rng = np.random.default_rng(0)
+    streamlines = [rng.uniform(0, 10, (rng.integers(2, 20), 3)).astype(
+        np.float32) for _ in range(nb_streamlines)]
+    data_per_point = {'fa': [rng.random((len(streamline), 1)).astype(
+        np.float32) for streamline in streamlines]}
+    data_per_streamline = {'weight': rng.random((nb_streamlines, 1)).astype(
+        np.float32)}
+    tractogram = nib.streamlines.Tractogram(
+        streamlines, data_per_point=data_per_point,
+        data_per_streamline=data_per_streamline, affine_to_rasmm=np.eye(4))
+    reference = nib.Nifti1Image(np.zeros((10, 10, 10), dtype=np.uint8),
+                                np.eye(4))
+
+    return tractogram, reference
+
+
+def _get_expected(tractogram):
+    """ Copy of the arrays of a tractogram (from_tractogram modifies it) """
+    return {'positions': tractogram.streamlines.get_data(),
+            'lengths': np.array(tractogram.streamlines._lengths),
+            'dpv': {key: tractogram.data_per_point[key].get_data()
+                    for key in tractogram.data_per_point},
+            'dps': {key: np.array(tractogram.data_per_streamline[key])
+                    for key in tractogram.data_per_streamline}}
+
+
+def _assert_same_data(trx, expected):
+    """ Streamlines, dpv and dps of a TrxFile match the expected arrays """
+    np.testing.assert_array_equal(np.asarray(trx.streamlines._data),
+                                  expected['positions'])
+    np.testing.assert_array_equal(trx.streamlines._lengths,
+                                  expected['lengths'])
+    assert sorted(trx.data_per_vertex.keys()) == sorted(expected['dpv'])
+    for key in expected['dpv']:
+        np.testing.assert_array_equal(
+            np.asarray(trx.data_per_vertex[key]._data), expected['dpv'][key])
+    assert sorted(trx.data_per_streamline.keys()) == sorted(expected['dps'])
+    for key in expected['dps']:
+        np.testing.assert_array_equal(trx.data_per_streamline[key],
+                                      expected['dps'][key])
+
+
+def _get_trx():
+    """ TrxFile (on disk) of a random tractogram, with its expected arrays """
+    tractogram, reference = _get_tractogram()
+    expected = _get_expected(tractogram)
+    trx = TrxFile.from_tractogram(tractogram, reference,
+                                  cast_position=np.float32)
+
+    return trx, expected
+
+
+def test_from_tractogram_round_trip(tmp_path):
+    trx, expected = _get_trx()
+    _assert_same_data(trx, expected)
+
+    filename = os.path.join(tmp_path, 'round_trip.trx')
+    save(trx, filename)
+    _assert_same_data(load(filename), expected)
+
+
+def test_chunked_to_memory(tmp_path):
+    trx, expected = _get_trx()
+    filename = os.path.join(tmp_path, 'chunked.trx')
+    save(trx, filename, block_size=64, block_filter='shuffle')
+
+    chunked_trx = load(filename)
+    _assert_same_data(chunked_trx, expected)
+    _assert_same_data(chunked_trx.to_memory(), expected)
+    tractogram = chunked_trx.to_tractogram()
+    np.testing.assert_array_equal(tractogram.streamlines.get_data(),
+                                  expected['positions'])
+
+
+def test_lazy_decompression_to_sft(tmp_path):
+    trx, expected = _get_trx()
+    filename = os.path.join(tmp_path, 'deflated.trx')
+    save(trx, filename, compression_standard=zipfile.ZIP_DEFLATED)
+
+    lazy_trx = load(filename, lazy_decompression=True)
+    sft = lazy_trx.to_sft()
+    np.testing.assert_array_equal(sft.streamlines.get_data(),
+                                  expected['positions'])
+    for key in expected['dpv']:
+        np.testing.assert_array_equal(sft.data_per_point[key].get_data(),
+                                      expected['dpv'][key])
+    for key in expected['dps']:
+        np.testing.assert_array_equal(sft.data_per_streamline[key],
+                                      expected['dps'][key])
+
+
+def test_resample_summaries():
+    trx, _ = _get_trx()
+    trx.compute_summaries()
+    resampled = trx.resample(5)
+
+    lengths = [np.sum(np.linalg.norm(np.diff(streamline.astype(np.float64),
+                                             axis=0), axis=1))
+               for streamline in resampled.streamlines]
+    np.testing.assert_allclose(
+        resampled.data_per_streamline['summary_length'].ravel(), lengths,
+        rtol=1e-5)
+    np.testing.assert_array_equal(
+        resampled.data_per_streamline['weight'],
+        trx.data_per_streamline['weight'])
+
+
+def test_parallel_deflate_zip64(tmp_path, monkeypatch):
+    # Every member and the central directory use the zip64 records
+    monkeypatch.setattr(trx_file_memmap, 'ZIP64_LIMIT', 1000)
+    trx, expected = _get_trx()
+    filename = os.path.join(tmp_path, 'parallel.trx')
+    save(trx, filename, compression_standard=zipfile.ZIP_DEFLATED,
+         nb_threads=3)
+
+    with zipfile.ZipFile(filename, mode='r') as zf:
+        assert zf.testzip() is None
+        assert any(info.extra for info in zf.infolist())
+        assert all(info.compress_type == zipfile.ZIP_DEFLATED
+                   for info in zf.infolist())
+    _assert_same_data(load(filename), expected)
+
+
+def test_save_keeps_header_keys(tmp_path):
+    trx, _ = _get_trx()
+    trx.header['CUSTOM'] = 'custom value'
+    filename = os.path.join(tmp_path, 'header.trx')
+    save(trx, filename)
+
+    assert load(filename).header['CUSTOM'] == 'custom value'
+
+
+def test_concatenate_to_file(tmp_path):
+    trx, expected = _get_trx()
+    trx.build_spatial_index()
+    filenames = []
+    for i, compression_standard in enumerate([zipfile.ZIP_STORED,
+                                              zipfile.ZIP_DEFLATED]):
+        filenames.append(os.path.join(tmp_path, '{}.trx'.format(i)))
+        save(trx, filenames[-1], compression_standard=compression_standard)
+
+    filename = os.path.join(tmp_path, 'concatenated.trx')
+    for inputs in [[trx, trx], filenames]:
+        concatenate_to_file(inputs, filename)
+        concatenated = load(filename)
+        assert not concatenated.spatial_index
+        _assert_same_data(concatenated, {
+            'positions': np.concatenate([expected['positions']] * 2),
+            'lengths': np.concatenate([expected['lengths']] * 2),
+            'dpv': {key: np.concatenate([value] * 2)
+                    for key, value in expected['dpv'].items()},
+            'dps': {key: np.concatenate([value] * 2)
+                    for key, value in expected['dps'].items()}})
+
+
+def test_group_bitmaps_after_append():
+    trx, _ = _get_trx()
+    accumulated = trx.select(np.arange(10), copy_safe=True)
+    accumulated.groups['group'] = np.array([1, 2, 8], dtype=np.uint32)
+    # Cache the bitmaps before growing
+    accumulated.select([1, 2])
+    accumulated.get_groups_indices(('complement', 'group'))
+
+    accumulated.append(trx.select(np.arange(10, 40), copy_safe=True))
+    selected = accumulated.select([1, 35])
+    np.testing.assert_array_equal(selected.groups['group'], [0])
+    complement = accumulated.get_groups_indices(('complement', 'group'))
+    assert len(complement) == len(accumulated) - 3
+
+
+def test_resize_keeps_spatial_index():
+    trx, _ = _get_trx()
+    trx.build_spatial_index()
+    trx.resize()
+    assert trx.spatial_index
+
+
+def test_quantized_positions(tmp_path):
+    trx, expected = _get_trx()
+    filename = os.path.join(tmp_path, 'quantized.trx')
+    save(trx, filename, quantize_positions=np.int16)
+
+    quantized_trx = load(filename)
+    scale = quantized_trx.streamlines._data.scale
+    positions = np.asarray(quantized_trx.streamlines._data)
+    assert np.all(np.abs(positions - expected['positions'])
+                  <= scale / 2 + 1e-6)
+    selected = quantized_trx.select([3, 7])
+    for i, streamline in zip([3, 7], selected.streamlines):
+        np.testing.assert_array_equal(streamline,
+                                      quantized_trx.streamlines[i])
@@ -1,19 +1,36 @@
+from collections import deque, OrderedDict
+from collections.abc import MutableMapping
+from concurrent.futures import ThreadPoolExecutor
 from copy import deepcopy
+from functools import partial, reduce
+import itertools
 import json
 import logging
 import os
 import shutil
+import struct
 import tempfile
+import threading
+import time
 import zipfile
+import zlib
 
 from dipy.io.stateful_tractogram import StatefulTractogram, Space
 from dipy.io.utils import get_reference_info
 import nibabel as nib
-from nibabel.affines import voxel_sizes
+from nibabel.affines import apply_affine, voxel_sizes
 from nibabel.orientations import aff2axcodes
 from nibabel.streamlines.array_sequence import ArraySequence
+from nibabel.streamlines.trk import (decode_value_from_name,
+                                     get_affine_trackvis_to_rasmm)
 import numpy as np
 
+from file_format_utils.file_format_utils import (bitmap_complement,
+                                                 bitmap_contains,
+                                                 bitmap_to_group, get_index,
+                                                 group_to_bitmap,
+                                                 read_trk_records)
+
 
 def _generate_filename_from_data(arr, filename):
     base, ext = os.path.splitext(filename)
@@ -53,22 +70,21 @@ def _split_ext_with_dimensionality(filename):
 
 
 def _compute_lengths(offsets, nb_vertices):
-    """ Compute lengths from offsets and header information """
+    """ Compute lengths from offsets and header information (offsets are
+    never modified, trailing zeros of preallocation have a length of 0) """
+    lengths = np.zeros(len(offsets), dtype=np.uint32)
     if len(offsets) > 1:
         last_elem_pos = _dichotomic_search(offsets)
-        if last_elem_pos == len(offsets)-1:
-            lengths = np.ediff1d(offsets, to_end=nb_vertices-offsets[-1])
-        else:
-            tmp = offsets
-            tmp[last_elem_pos+1] = nb_vertices
-            lengths = np.ediff1d(tmp, to_end=0)
-            lengths[last_elem_pos+1] = 0
+        end = last_elem_pos + 1
+        if end > 0:
+            bounds = np.concatenate([offsets[:end],
+                                     np.array([nb_vertices],
+                                              dtype=offsets.dtype)])
+            lengths[:end] = np.diff(bounds)
     elif len(offsets) == 1:
-        lengths = np.array([nb_vertices])
-    else:
-        lengths = np.array([0])
+        lengths[0] = nb_vertices
 
-    return lengths.astype(np.uint32)
+    return lengths
 
 
 def _is_dtype_valid(ext):
@@ -87,15 +103,14 @@ def _dichotomic_search(x, l_bound=None, r_bound=None):
         l_bound = 0
         r_bound = len(x)-1
 
-    if l_bound == r_bound:
-        val = l_bound if x[l_bound] != 0 else -1
-        return val
+    while l_bound != r_bound:
+        mid_bound = (l_bound + r_bound + 1) // 2
+        if x[mid_bound] == 0:
+            r_bound = mid_bound-1
+        else:
+            l_bound = mid_bound
 
-    mid_bound = (l_bound + r_bound + 1) // 2
-    if x[mid_bound] == 0:
-        return _dichotomic_search(x, l_bound, mid_bound-1)
-    else:
-        return _dichotomic_search(x, mid_bound, r_bound)
+    return l_bound if x[l_bound] != 0 else -1
 
 
 def _create_memmap(filename, mode='r', shape=(1,), dtype=np.float32, offset=0,
@@ -114,8 +129,564 @@ def _create_memmap(filename, mode='r', shape=(1,), dtype=np.float32, offset=0,
         return np.zeros(shape, dtype=dtype)
 
 
-def load(input_obj, check_dpg=True):
-    """ Load a TrxFile (compressed or not) """
+def _trim_group(group, strs_end):
+    """ Remove the streamlines from strs_end of a group (indices or .bit) """
+    group = np.asarray(group)
+    if group.dtype == bool:
+        return group[0:strs_end]
+    return group[group < strs_end]
+
+
+def _get_brick_grid(dimensions, brick_size):
+    """ Number of bricks (cubes of brick_size voxels) along each axis """
+    return tuple(int(np.ceil(dim / brick_size)) for dim in dimensions)
+
+
+def _get_voxels(positions, affine):
+    """ Voxel (center origin) of positions in world space (RASMM) """
+    voxels = apply_affine(np.linalg.inv(affine), positions) + 0.5
+    return np.floor(voxels).astype(np.int64)
+
+
+def _get_bricks(positions, affine, dimensions, brick_size):
+    """ Linear index of the brick of positions, positions outside of the
+    volume are attributed to the closest brick """
+    voxels = np.clip(_get_voxels(positions, affine), 0,
+                     np.asarray(dimensions, dtype=np.int64) - 1)
+    return np.ravel_multi_index(tuple((voxels // brick_size).T),
+                                _get_brick_grid(dimensions, brick_size))
+
+
+def _get_quantization(chunks, dtype):
+    """ Scale and offset (per axis) mapping the range of the positions to
+    the range of an integer dtype, positions = stored * scale + offset """
+    pos_min = np.full((3,), np.inf)
+    pos_max = np.full((3,), -np.inf)
+    for chunk in chunks:
+        if len(chunk):
+            pos_min = np.minimum(pos_min, np.min(chunk, axis=0))
+            pos_max = np.maximum(pos_max, np.max(chunk, axis=0))
+    if not np.all(np.isfinite(pos_min)):
+        pos_min, pos_max = np.zeros((3,)), np.zeros((3,))
+
+    info = np.iinfo(dtype)
+    scale = (pos_max - pos_min) / (float(info.max) - float(info.min))
+    scale[scale == 0] = 1
+    offset = pos_min - info.min * scale
+
+    return scale, offset
+
+
+def _quantize_chunks(chunks, scale, offset, dtype):
+    """ Encode blocks of positions as an integer dtype """
+    info = np.iinfo(dtype)
+    for chunk in chunks:
+        stored = np.round((np.asarray(chunk, dtype=np.float64) - offset)
+                          / scale)
+        yield np.clip(stored, info.min, info.max).astype(dtype)
+
+
+def _get_header_to_save(header, nb_vertices, nb_streamlines):
+    """ Copy of a header, serializable as json, with new sizes and without
+    the keys describing the arrays of a specific file (added back when
+    saving these arrays) """
+    header = deepcopy(header)
+    for key in ['SPATIAL_INDEX_BRICK_SIZE', 'POSITIONS_SCALE',
+                'POSITIONS_OFFSET', 'CHUNKED']:
+        header.pop(key, None)
+    header['DIMENSIONS'] = np.asarray(header['DIMENSIONS']).tolist()
+    header['VOXEL_TO_RASMM'] = np.asarray(header['VOXEL_TO_RASMM']).tolist()
+    header['NB_VERTICES'] = int(nb_vertices)
+    header['NB_STREAMLINES'] = int(nb_streamlines)
+
+    return header
+
+
+def _get_zip_data_offset(zf, zip_info):
+    """ Position of the data of a zip member, from its local header (its
+    extra field can differ from the one of the central directory) """
+    zf.fp.seek(zip_info.header_offset)
+    local_header = zf.fp.read(30)
+    filename_len, extra_len = struct.unpack('<HH', local_header[26:30])
+
+    return zip_info.header_offset + 30 + filename_len + extra_len
+
+
+def _decompress_zip_member(zip_filename, member, shape, dtype,
+                           scratch_dir=None):
+    """ Decompress a single member of a zip, in RAM or in a scratch memmap """
+    if scratch_dir is not None:
+        arr = _create_memmap(os.path.join(scratch_dir,
+                                          member.replace('/', '_')),
+                             mode='w+', shape=shape, dtype=dtype)
+    else:
+        arr = np.empty(shape, dtype=dtype)
+
+    if arr.size == 0:
+        return arr
+
+    buf = memoryview(arr.reshape(-1)).cast('B')
+    with zipfile.ZipFile(zip_filename, mode='r') as zf:
+        with zf.open(member) as zf_member:
+            pos = 0
+            while pos < len(buf):
+                nb_bytes = zf_member.readinto(buf[pos:])
+                if nb_bytes == 0:
+                    raise ValueError('Wrong size or datatype')
+                pos += nb_bytes
+    logging.debug('Decompressed {} from {}'.format(member, zip_filename))
+
+    return arr
+
+
+class _ZipMemberLoader():
+    """ Loader of a compressed member of a zip, decompressed whole when
+    called, or streamed by blocks with iter_chunks """
+
+    def __init__(self, zip_filename, member, shape, dtype, scratch_dir=None):
+        self.zip_filename = zip_filename
+        self.member = member
+        self.shape = tuple(shape)
+        self.dtype = np.dtype(dtype)
+        self.ndim = len(self.shape)
+        self.scratch_dir = scratch_dir
+
+    def __len__(self):
+        return self.shape[0]
+
+    def __call__(self):
+        return _decompress_zip_member(self.zip_filename, self.member,
+                                      self.shape, self.dtype,
+                                      scratch_dir=self.scratch_dir)
+
+    def iter_chunks(self, start=0, end=None):
+        """ Yield the rows [start, end) of the array by blocks of about
+        WRITE_CHUNK_SIZE bytes, decompressing a single block at a time """
+        end = self.shape[0] if end is None else end
+        row_size = max(1, int(np.prod(self.shape[1:])) * self.dtype.itemsize)
+        nb_rows = max(1, WRITE_CHUNK_SIZE // row_size)
+        pos = 0
+        with zipfile.ZipFile(self.zip_filename, mode='r') as zf:
+            with zf.open(self.member) as zf_member:
+                while pos < end:
+                    data = zf_member.read(nb_rows * row_size)
+                    if len(data) == 0:
+                        raise ValueError('Wrong size or datatype')
+                    chunk = np.frombuffer(data, dtype=self.dtype).reshape(
+                        (-1,) + self.shape[1:])
+                    if pos + len(chunk) > start:
+                        yield chunk[max(0, start - pos):end - pos]
+                    pos += len(chunk)
+
+
+def _peek_data(value):
+    """ Data of an ArraySequence (or an array), or its loader if it is not
+    loaded yet (lazy decompression), without loading it """
+    if isinstance(value, _LazyArraySequence) and \
+            isinstance(value._data_loader, _ZipMemberLoader):
+        return value._data_loader
+    return value._data if isinstance(value, ArraySequence) else value
+
+
+class _LazyDict(MutableMapping):
+    """ Dictionary of arrays, values declared as loaders (callable) are only
+    loaded on first access (a mapping rather than a dict subclass, so that
+    copies such as dict(lazy_dict) load them too) """
+
+    def __init__(self, *args, **kwargs):
+        self._values = dict(*args, **kwargs)
+
+    def __getitem__(self, key):
+        value = self._values[key]
+        if callable(value):
+            value = value()
+            self._values[key] = value
+        return value
+
+    def __setitem__(self, key, value):
+        self._values[key] = value
+
+    def __delitem__(self, key):
+        del self._values[key]
+
+    def __contains__(self, key):
+        return key in self._values
+
+    def __iter__(self):
+        return iter(self._values)
+
+    def __len__(self):
+        return len(self._values)
+
+    def peek(self, key):
+        """ Value of a key, or its loader if it is not loaded yet """
+        return self._values[key]
+
+    def __deepcopy__(self, memo):
+        return _LazyDict((key, deepcopy(self[key], memo)) for key in self)
+
+
+def _peek_item(container, key):
+    """ Value of a dict, or its loader if it is a _LazyDict value that is
+    not loaded yet """
+    if isinstance(container, _LazyDict):
+        return container.peek(key)
+    return container[key]
+
+
+class _LazyArraySequence(ArraySequence):
+    """ ArraySequence whose data is only loaded on first access """
+
+    def __init__(self, iterable=None, buffer_size=4, data_loader=None):
+        self._data_loader = None
+        super().__init__(iterable, buffer_size)
+        self._data_loader = data_loader
+
+    @property
+    def _data(self):
+        if self._data_loader is not None:
+            self.__dict__['_lazy_data'] = self._data_loader()
+            self._data_loader = None
+        return self.__dict__['_lazy_data']
+
+    @_data.setter
+    def _data(self, value):
+        self._data_loader = None
+        self.__dict__['_lazy_data'] = value
+
+
+BLOCK_FILTERS = [None, 'shuffle', 'delta']
+
+
+def _get_block_table_filename(elem_filename):
+    """ Relative filename of the block offset table of a chunked array """
+    base, _, _ = _split_ext_with_dimensionality(elem_filename)
+    return os.path.join('chunks', os.path.dirname(elem_filename),
+                        '{}.uint64'.format(base))
+
+
+def _filter_block(block, block_filter=None):
+    """ Bytes of a block (rows of an array) before compression, delta
+    (wrap-around difference between rows, on the bits of the values)
+    and/or byte-shuffle (n-th byte of all values, then the next) """
+    block = np.ascontiguousarray(block)
+    itemsize = block.dtype.itemsize
+    if block_filter == 'delta':
+        bits = block.view('<u{}'.format(itemsize))
+        block = bits.copy()
+        block[1:] -= bits[:-1]
+    if block_filter in ['shuffle', 'delta']:
+        block = block.view(np.uint8).reshape((-1, itemsize)).T
+    return np.ascontiguousarray(block).tobytes()
+
+
+def _unfilter_block(data, shape, dtype, block_filter=None):
+    """ Rows of an array from the (decompressed) bytes of a block """
+    dtype = np.dtype(dtype)
+    block = np.frombuffer(data, dtype=np.uint8)
+    if block_filter in ['shuffle', 'delta']:
+        block = np.ascontiguousarray(block.reshape((dtype.itemsize, -1)).T)
+    if block_filter == 'delta':
+        bits = block.view('<u{}'.format(dtype.itemsize)).reshape(shape)
+        block = np.cumsum(bits, axis=0, dtype=bits.dtype)
+    return block.view(dtype).reshape(shape)
+
+
+class _ChunkedArray():
+    """ Read-only array stored as independently compressed blocks of rows
+    (after a block offset table), only the blocks touched by an indexing are
+    decompressed and the last ones are kept in a small cache """
+
+    def __init__(self, filename, offset, shape, dtype, block_offsets,
+                 block_size, block_filter=None, cache_size=16):
+        self.filename = filename
+        self.shape = tuple(int(i) for i in shape)
+        self.dtype = np.dtype(dtype)
+        self.ndim = len(self.shape)
+        self.size = int(np.prod(self.shape))
+        self.nbytes = self.size * self.dtype.itemsize
+        self.block_size = int(block_size)
+        self.block_filter = block_filter
+
+        nb_blocks = -(-self.shape[0] // self.block_size)
+        if len(block_offsets) != nb_blocks + 1 or \
+                block_filter not in BLOCK_FILTERS:
+            raise ValueError('Wrong block table or filter.')
+        self._block_offsets = np.asarray(block_offsets, dtype=np.int64) \
+            + offset
+        self._cache = OrderedDict()
+        self._cache_size = cache_size
+        self._lock = threading.Lock()
+
+    def __len__(self):
+        return self.shape[0]
+
+    def __array__(self, dtype=None, copy=None):
+        arr = self[0:len(self)]
+        return arr if dtype is None else arr.astype(dtype)
+
+    def __deepcopy__(self, memo):
+        # A copy is decompressed in RAM (the lock cannot be copied)
+        return self[0:len(self)]
+
+    def _get_block(self, block_id):
+        """ Decompress a block (or get it from the cache) """
+        with self._lock:
+            if block_id in self._cache:
+                self._cache.move_to_end(block_id)
+                return self._cache[block_id]
+
+        start = int(self._block_offsets[block_id])
+        end = int(self._block_offsets[block_id + 1])
+        with open(self.filename, 'rb') as f:
+            f.seek(start)
+            data = zlib.decompress(f.read(end - start))
+        nb_rows = min(self.block_size, len(self) - block_id * self.block_size)
+        block = _unfilter_block(data, (nb_rows,) + self.shape[1:],
+                                self.dtype, self.block_filter)
+
+        with self._lock:
+            self._cache[block_id] = block
+            if len(self._cache) > self._cache_size:
+                self._cache.popitem(last=False)
+        return block
+
+    def _get_rows(self, rows):
+        """ Rows (sorted or not) of the array, from the blocks they are in """
+        out = np.empty((len(rows),) + self.shape[1:], dtype=self.dtype)
+        block_ids = rows // self.block_size
+        for block_id in np.unique(block_ids):
+            mask = block_ids == block_id
+            out[mask] = self._get_block(int(block_id))[
+                rows[mask] - block_id * self.block_size]
+        return out
+
+    def _get_range(self, start, end):
+        """ Contiguous rows [start, end) of the array """
+        if end <= start:
+            return np.empty((0,) + self.shape[1:], dtype=self.dtype)
+        first, last = start // self.block_size, (end - 1) // self.block_size
+        if first == last:
+            pos = first * self.block_size
+            return self._get_block(first)[start - pos:end - pos].copy()
+
+        out = np.empty((end - start,) + self.shape[1:], dtype=self.dtype)
+        for block_id in range(first, last + 1):
+            pos = block_id * self.block_size
+            block_start, block_end = max(start, pos), \
+                min(end, pos + self.block_size)
+            out[block_start - start:block_end - start] = self._get_block(
+                block_id)[block_start - pos:block_end - pos]
+        return out
+
+    def __getitem__(self, key):
+        if not isinstance(key, tuple):
+            key = (key,)
+        rows, others = key[0], key[1:]
+
+        if isinstance(rows, slice):
+            start, end, step = rows.indices(len(self))
+            if step < 0:
+                arr = self._get_range(end + 1, start + 1)[::step]
+            else:
+                arr = self._get_range(start, end)[::step]
+        elif np.ndim(rows) == 0 and not isinstance(rows, (bool, np.bool_)):
+            row = int(rows) + len(self) if rows < 0 else int(rows)
+            if not 0 <= row < len(self):
+                raise IndexError('Index out of range.')
+            arr = self._get_range(row, row + 1)[0]
+        else:
+            rows = np.asarray(rows)
+            if rows.dtype == bool:
+                rows = np.flatnonzero(rows)
+            rows = rows.astype(np.int64)
+            rows[rows < 0] += len(self)
+            arr = self._get_rows(rows.reshape(-1)).reshape(
+                rows.shape + self.shape[1:])
+
+        if others:
+            arr = arr[(slice(None),) * (arr.ndim - self.ndim + 1) + others]
+        return arr
+
+    def tofile(self, filename):
+        """ Write the (decompressed) array to a file """
+        with open(filename, 'wb') as f:
+            _write_chunks(f, _iter_chunks(self))
+
+
+class _QuantizedArray():
+    """ Read-only (float32) array of positions quantized as integers, only
+    the rows that are indexed are decoded, positions = stored * scale +
+    offset (stored can be the loader of a compressed member) """
+
+    def __init__(self, stored, scale, offset):
+        self._stored = stored
+        self.scale = np.asarray(scale, dtype=np.float64)
+        self.offset = np.asarray(offset, dtype=np.float64)
+        self.shape = tuple(stored.shape)
+        self.dtype = np.dtype(np.float32)
+        self.ndim = len(self.shape)
+        self.size = int(np.prod(self.shape))
+        self.nbytes = self.size * self.dtype.itemsize
+
+    def __len__(self):
+        return self.shape[0]
+
+    def __array__(self, dtype=None, copy=None):
+        arr = self[0:len(self)]
+        return arr if dtype is None else arr.astype(dtype)
+
+    @property
+    def stored(self):
+        if isinstance(self._stored, _ZipMemberLoader):
+            self._stored = self._stored()
+        return self._stored
+
+    def decode(self, stored):
+        """ Positions (float32) from rows of stored integers """
+        return (stored * self.scale + self.offset).astype(np.float32)
+
+    def __getitem__(self, key):
+        if not isinstance(key, tuple):
+            key = (key,)
+        # Whole rows are decoded (scale and offset are per axis)
+        arr = self.decode(self.stored[key[0]])
+        if key[1:]:
+            arr = arr[(slice(None),) * (arr.ndim - self.ndim + 1) + key[1:]]
+        return arr
+
+    def tofile(self, filename):
+        """ Write the decoded array to a file """
+        with open(filename, 'wb') as f:
+            _write_chunks(f, _iter_chunks(self))
+
+
+def _is_key_selected(elem_filename, include=None, exclude=None):
+    """ Check if an array (relative filename) must be loaded, include and
+    exclude are dict of keys lists for dpv, dps, groups and/or dpg """
+    for selection in [include, exclude]:
+        if selection is None:
+            continue
+        for category in selection.keys():
+            if category not in ['dpv', 'dps', 'groups', 'dpg']:
+                raise ValueError('Invalid key category: {}'.format(category))
+
+    def _is_selected(category, key):
+        if include is not None and category in include \
+                and key not in include[category]:
+            return False
+        if exclude is not None and category in exclude \
+                and key in exclude[category]:
+            return False
+        return True
+
+    folder = os.path.dirname(elem_filename)
+    base = os.path.basename(elem_filename).split('.')[0]
+    if folder in ['dpv', 'dps', 'groups']:
+        return _is_selected(folder, base)
+    elif folder.startswith('dpg'):
+        # Data of a group that is not loaded is not loaded either
+        return _is_selected('groups', os.path.basename(folder)) \
+            and _is_selected('dpg', base)
+
+    return True
+
+
+def _parse_header(header):
+    """ Convert the space attributes of a json header to arrays """
+    header['VOXEL_TO_RASMM'] = np.reshape(header['VOXEL_TO_RASMM'],
+                                          (4, 4)).astype(np.float32)
+    header['DIMENSIONS'] = np.array(header['DIMENSIONS'], dtype=np.uint16)
+
+    return header
+
+
+def load_metadata(input_obj):
+    """ Read the header and the structure of a TrxFile (compressed or not)
+    without opening, mapping or decompressing any array
+
+    Return a dict with the header and, for positions, offsets, lengths
+    (None if not persisted), dpv, dps, groups, dpg (per group) and the
+    spatial index, the
+    dtype, shape, number of bytes and size on disk (compressed size for zip
+    members or arrays compressed by blocks) of each array """
+    members = []
+    if os.path.isfile(input_obj):
+        with zipfile.ZipFile(input_obj, mode='r') as zf:
+            with zf.open('header.json') as zf_header:
+                header = _parse_header(json.load(zf_header))
+            for zip_info in zf.infolist():
+                if not zip_info.is_dir():
+                    members.append((zip_info.filename, zip_info.file_size,
+                                    zip_info.compress_size))
+    elif os.path.isdir(input_obj):
+        directory = os.path.abspath(input_obj)
+        with open(os.path.join(directory, 'header.json')) as header:
+            header = _parse_header(json.load(header))
+        for root, dirs, files in os.walk(directory):
+            for name in files:
+                elem_filename = os.path.join(root, name)
+                size = os.path.getsize(elem_filename)
+                members.append((os.path.relpath(elem_filename, directory),
+                                size, size))
+    else:
+        raise ValueError('File/Folder does not exist')
+
+    metadata = {'header': header, 'positions': None, 'offsets': None,
+                'lengths': None, 'dpv': {}, 'dps': {}, 'groups': {}, 'dpg': {},
+                'spatial_index': {}}
+    for elem_filename, nbytes, size_on_disk in members:
+        _, ext = os.path.splitext(elem_filename)
+        if ext == '.json' or not _is_dtype_valid(ext) or \
+                elem_filename.split(os.sep)[0] == 'chunks':
+            continue
+        folder = os.path.dirname(elem_filename)
+        base, dim, ext = _split_ext_with_dimensionality(elem_filename)
+        dtype = np.dtype('bool' if ext == '.bit' else ext[1:])
+        size = nbytes // dtype.itemsize
+        if elem_filename in header.get('CHUNKED', {}):
+            size = header['CHUNKED'][elem_filename]['SIZE']
+            nbytes = size * dtype.itemsize
+
+        # Same shapes as the arrays of a loaded TrxFile
+        if folder in ['groups', 'spatial_index'] or \
+                (folder == '' and base in ['offsets', 'lengths']):
+            shape = (size,)
+        elif folder.startswith('dpg'):
+            shape = (1, size)
+        else:
+            shape = (size // dim, dim)
+
+        info = {'dtype': dtype, 'shape': shape, 'nbytes': nbytes,
+                'size_on_disk': size_on_disk}
+        if folder == '' and base in ['positions', 'offsets', 'lengths']:
+            metadata[base] = info
+        elif folder in ['dpv', 'dps', 'groups', 'spatial_index']:
+            metadata[folder][base] = info
+        elif folder.startswith('dpg'):
+            group_key = os.path.basename(folder)
+            if group_key not in metadata['dpg']:
+                metadata['dpg'][group_key] = {}
+            metadata['dpg'][group_key][base] = info
+
+    return metadata
+
+
+def load(input_obj, check_dpg=True, lazy_decompression=False,
+         scratch_dir=None, include=None, exclude=None, check_lengths=False):
+    """ Load a TrxFile (compressed or not)
+
+    Compressed files are extracted to a temporary folder, unless
+    lazy_decompression is True, then each compressed array is decompressed
+    on first access (in RAM, or in scratch_dir if provided), while
+    uncompressed members stay memmaps of the zip
+
+    Only a subset of dpv, dps, groups and dpg can be loaded using include
+    and/or exclude, dict of keys lists such as {'dpv': ['fa']}, the other
+    arrays are never opened (nor extracted)
+
+    Persisted lengths (lengths.uint32) are used as is, unless check_lengths
+    is True, then they are validated against the offsets """
     # TODO Check if 0 streamlines, if yes then 0 vertices is expected (vice-versa)
     # TODO 4x4 affine matrices should contains values (no all-zeros)
     # TODO 3x1 dimensions array should contains values at each position (int)
@@ -126,18 +697,24 @@ def load(input_obj, check_dpg=True):
                 if info.compress_type != 0:
                     was_compressed = True
                     break
-        if was_compressed:
+        if was_compressed and lazy_decompression:
+            trx = load_from_zip(input_obj, scratch_dir=scratch_dir,
+                                include=include, exclude=exclude)
+        elif was_compressed:
             with zipfile.ZipFile(input_obj, 'r') as zf:
                 tmpdir = tempfile.TemporaryDirectory()
-                zf.extractall(tmpdir.name)
+                members = [name for name in zf.namelist()
+                           if _is_key_selected(name, include, exclude)]
+                zf.extractall(tmpdir.name, members=members)
                 trx = load_from_directory(tmpdir.name)
                 trx._uncompressed_folder_handle = tmpdir
                 logging.info('File was compressed, call the close() '
                              'function before exiting.')
         else:
-            trx = load_from_zip(input_obj)
+            trx = load_from_zip(input_obj, include=include, exclude=exclude)
     elif os.path.isdir(input_obj):
-        trx = load_from_directory(input_obj)
+        trx = load_from_directory(input_obj, include=include,
+                                  exclude=exclude)
     else:
         raise ValueError('File/Folder does not exist')
 
@@ -148,26 +725,29 @@ def load(input_obj, check_dpg=True):
                 raise ValueError('An undeclared group ({}) has '
                                  'data_per_group.'.format(dpg))
 
+    if check_lengths:
+        trx.validate_lengths()
+
     return trx
 
 
-def load_from_zip(filename):
-    """ Load a TrxFile from a single zipfile """
+def load_from_zip(filename, scratch_dir=None, include=None, exclude=None):
+    """ Load a TrxFile from a single zipfile (compressed members are
+    decompressed on first access, selection of keys, see load) """
     with zipfile.ZipFile(filename, mode='r') as zf:
         with zf.open('header.json') as zf_header:
-            header = json.load(zf_header)
-            header['VOXEL_TO_RASMM'] = np.reshape(header['VOXEL_TO_RASMM'],
-                                                  (4, 4)).astype(np.float32)
-            header['DIMENSIONS'] = np.array(header['DIMENSIONS'],
-                                            dtype=np.uint16)
+            header = _parse_header(json.load(zf_header))
 
         files_pointer_size = {}
+        compressed = set()
         for zip_info in zf.filelist:
             elem_filename = zip_info.filename
             _, ext = os.path.splitext(elem_filename)
             if ext == '.json' or zip_info.is_dir():
                 continue
-            
+            if not _is_key_selected(elem_filename, include, exclude):
+                continue
+
             if not _is_dtype_valid(ext):
                 continue
                 raise ValueError('The dtype {} is not supported'.format(
@@ -176,31 +756,41 @@ def load_from_zip(filename):
             if ext == '.bit':
                 ext = '.bool'
 
-            mem_adress = zip_info.header_offset + len(zip_info.FileHeader())
+            mem_adress = _get_zip_data_offset(zf, zip_info)
             dtype_size = np.dtype(ext[1:]).itemsize
             size = zip_info.file_size / dtype_size
-
-            if len(zip_info.extra):
-                mem_adress += 4
+            # Arrays compressed by blocks declare their size in the header
+            if elem_filename in header.get('CHUNKED', {}):
+                size = float(header['CHUNKED'][elem_filename]['SIZE'])
 
             if size.is_integer():
                 files_pointer_size[elem_filename] = mem_adress, int(size)
             else:
                 raise ValueError('Wrong size or datatype')
 
+            if zip_info.compress_type != zipfile.ZIP_STORED:
+                compressed.add(elem_filename)
+
+    if compressed and scratch_dir is not None:
+        tmp_dir = tempfile.TemporaryDirectory(dir=scratch_dir)
+        trx = TrxFile._create_trx_from_pointer(header, files_pointer_size,
+                                               root_zip=filename,
+                                               compressed=compressed,
+                                               scratch_dir=tmp_dir.name)
+        trx._uncompressed_folder_handle = tmp_dir
+        return trx
+
     return TrxFile._create_trx_from_pointer(header, files_pointer_size,
-                                            root_zip=filename)
+                                            root_zip=filename,
+                                            compressed=compressed)
 
 
-def load_from_directory(directory):
-    """ Load a TrxFile from a folder containing memmaps """
+def load_from_directory(directory, include=None, exclude=None):
+    """ Load a TrxFile from a folder containing memmaps (selection of keys,
+    see load) """
     directory = os.path.abspath(directory)
     with open(os.path.join(directory, 'header.json')) as header:
-        header = json.load(header)
-        header['VOXEL_TO_RASMM'] = np.reshape(header['VOXEL_TO_RASMM'],
-                                              (4, 4)).astype(np.float32)
-        header['DIMENSIONS'] = np.array(header['DIMENSIONS'],
-                                        dtype=np.uint16)
+        header = _parse_header(json.load(header))
     files_pointer_size = {}
     for root, dirs, files in os.walk(directory):
         for name in files:
@@ -208,7 +798,10 @@ def load_from_directory(directory):
             _, ext = os.path.splitext(elem_filename)
             if ext == '.json':
                 continue
-            
+            if not _is_key_selected(os.path.relpath(elem_filename, directory),
+                                    include, exclude):
+                continue
+
             if not _is_dtype_valid(ext):
                 raise ValueError('The dtype of {} is not supported'.format(
                     elem_filename))
@@ -218,6 +811,9 @@ def load_from_directory(directory):
 
             dtype_size = np.dtype(ext[1:]).itemsize
             size = os.path.getsize(elem_filename) / dtype_size
+            relative_filename = os.path.relpath(elem_filename, directory)
+            if relative_filename in header.get('CHUNKED', {}):
+                size = float(header['CHUNKED'][relative_filename]['SIZE'])
 
             if size.is_integer():
                 files_pointer_size[elem_filename] = 0, int(size)
@@ -230,15 +826,9 @@ def load_from_directory(directory):
                                             root=directory)
 
 
-def concatenate(trx_list, delete_dpv=False, delete_dps=False, delete_groups=False,
-                check_space_attributes=True, preallocation=False):
-    """ Concatenate multiple TrxFile together, support preallocation """
-    trx_list = [curr_trx for curr_trx in trx_list
-                if curr_trx.header['NB_STREAMLINES'] > 0]
-    if len(trx_list) == 0:
-        logging.warning('Inputs of concatenation were empty.')
-        return TrxFile()
-
+def _check_concatenate(trx_list, delete_dpv=False, delete_dps=False,
+                       check_space_attributes=True):
+    """ Verify that TrxFile can be concatenated (space, dpv and dps) """
     ref_trx = trx_list[0]
 
     if check_space_attributes:
@@ -249,10 +839,6 @@ def concatenate(trx_list, delete_dpv=False, delete_dps=False, delete_groups=Fals
                                           curr_trx.header['DIMENSIONS']):
                 raise ValueError('Wrong space attributes.')
 
-    if preallocation and not delete_groups:
-        raise ValueError('Groups are variables, cannot be handled with '
-                         'preallocation')
-
     # Verifying the validity of fixed-size arrays, coherence between inputs
     for curr_trx in trx_list[1:]:
         for key in curr_trx.data_per_vertex.keys():
@@ -262,8 +848,10 @@ def concatenate(trx_list, delete_dpv=False, delete_dps=False, delete_groups=Fals
                                   'TrxFile.'.format(key))
                     raise ValueError('TrxFile must be sharing identical dpv '
                                      'keys.')
-            elif ref_trx.data_per_vertex[key]._data.dtype != \
-                    curr_trx.data_per_vertex[key]._data.dtype:
+            elif _peek_data(_peek_item(ref_trx.data_per_vertex,
+                                       key)).dtype != \
+                    _peek_data(_peek_item(curr_trx.data_per_vertex,
+                                          key)).dtype:
                 logging.debug('{} dpv key is not declared with the same dtype '
                               'in all TrxFile.'.format(key))
                 raise ValueError('Shared dpv key, has different dtype.')
@@ -276,12 +864,35 @@ def concatenate(trx_list, delete_dpv=False, delete_dps=False, delete_groups=Fals
                                   'TrxFile.'.format(key))
                     raise ValueError('TrxFile must be sharing identical dps '
                                      'keys.')
-            elif ref_trx.data_per_streamline[key].dtype != \
-                    curr_trx.data_per_streamline[key].dtype:
+            elif _peek_item(ref_trx.data_per_streamline, key).dtype != \
+                    _peek_item(curr_trx.data_per_streamline, key).dtype:
                 logging.debug('{} dps key is not declared with the same dtype '
                               'in all TrxFile.'.format(key))
                 raise ValueError('Shared dps key, has different dtype.')
 
+
+def concatenate(trx_list, delete_dpv=False, delete_dps=False, delete_groups=False,
+                check_space_attributes=True, preallocation=False,
+                nb_threads=1):
+    """ Concatenate multiple TrxFile together, support preallocation
+
+    The destination of each TrxFile is known in advance, with nb_threads
+    the fixed-size arrays of the inputs are copied in parallel """
+    trx_list = [curr_trx for curr_trx in trx_list
+                if curr_trx.header['NB_STREAMLINES'] > 0]
+    if len(trx_list) == 0:
+        logging.warning('Inputs of concatenation were empty.')
+        return TrxFile()
+
+    ref_trx = trx_list[0]
+
+    if preallocation and not delete_groups:
+        raise ValueError('Groups are variables, cannot be handled with '
+                         'preallocation')
+
+    _check_concatenate(trx_list, delete_dpv=delete_dpv, delete_dps=delete_dps,
+                       check_space_attributes=check_space_attributes)
+
     all_groups_len = {}
     all_groups_dtype = {}
     # Variable-size arrays do not have to exist in all TrxFile
@@ -332,8 +943,10 @@ def concatenate(trx_list, delete_dpv=False, delete_dps=False, delete_groups=Fals
             count = 0
             for curr_trx in trx_list:
                 curr_len = len(curr_trx.groups[group_key])
+                # Groups stored as .bit (masks) are simply appended
+                shift = 0 if dtype == bool else count
                 new_trx.groups[group_key][0, pos:pos+curr_len] = \
-                    curr_trx.groups[group_key] + count
+                    curr_trx.groups[group_key] + shift
                 pos += curr_len
                 count += curr_trx.header['NB_STREAMLINES']
 
@@ -342,37 +955,539 @@ def concatenate(trx_list, delete_dpv=False, delete_dps=False, delete_groups=Fals
         new_trx = ref_trx
         strs_end, pts_end = new_trx._get_real_len()
 
+    # Disjoint destination of each TrxFile fixed-size info (the right chunk)
+    strs_starts, pts_starts = [], []
     for curr_trx in to_concat_list:
-        # Copy the TrxFile fixed-size info (the right chunk)
-        strs_end, pts_end = new_trx._copy_fixed_arrays_from(curr_trx,
-                                                            strs_start=strs_end,
-                                                            pts_start=pts_end)
+        strs_starts.append(strs_end)
+        pts_starts.append(pts_end)
+        curr_strs_len, curr_pts_len = curr_trx._get_real_len()
+        strs_end += curr_strs_len
+        pts_end += curr_pts_len
+
+    if nb_threads > 1 and len(to_concat_list) > 1:
+        with ThreadPoolExecutor(max_workers=nb_threads) as executor:
+            list(executor.map(new_trx._copy_fixed_arrays_from,
+                              to_concat_list, strs_starts, pts_starts))
+    else:
+        for curr_trx, strs_start, pts_start in zip(to_concat_list,
+                                                   strs_starts, pts_starts):
+            new_trx._copy_fixed_arrays_from(curr_trx, strs_start=strs_start,
+                                            pts_start=pts_start)
     return new_trx
 
 
-def save(trx, filename, compression_standard=zipfile.ZIP_STORED):
-    """ Save a TrxFile (compressed or not) """
+# Size of the blocks streamed from the memmaps to the files when saving
+WRITE_CHUNK_SIZE = 64 * 1024 * 1024
+
+
+def _iter_chunks(arr, start=0, end=None):
+    """ Yield the rows [start, end) of an array (or of a compressed zip
+    member, streamed) by blocks of about WRITE_CHUNK_SIZE bytes """
+    if isinstance(arr, _ZipMemberLoader):
+        yield from arr.iter_chunks(start, end)
+        return
+    if isinstance(arr, _QuantizedArray):
+        for chunk in _iter_chunks(arr._stored, start, end):
+            yield arr.decode(chunk)
+        return
+
+    end = len(arr) if end is None else end
+    row_size = max(1, int(np.prod(arr.shape[1:])) * arr.dtype.itemsize)
+    nb_rows = max(1, WRITE_CHUNK_SIZE // row_size)
+    for pos in range(start, end, nb_rows):
+        yield arr[pos:min(pos + nb_rows, end)]
+
+
+def _get_chunk_bounds(lengths, nb_rows):
+    """ Split streamlines into ranges [start, end) of whole streamlines of
+    at most nb_rows vertices (or a single longer streamline) """
+    cumsum = np.cumsum(lengths, dtype=np.int64)
+    bounds = []
+    start = 0
+    while start < len(lengths):
+        end = int(np.searchsorted(cumsum, cumsum[start] - lengths[start]
+                                  + nb_rows, side='right'))
+        end = max(end, start + 1)
+        bounds.append((start, end))
+        start = end
+
+    return bounds
+
+
+def _iter_gathered_chunks(data, offsets, lengths):
+    """ Yield the rows of the (offsets, lengths) ranges of data, in order,
+    gathered by blocks of about WRITE_CHUNK_SIZE bytes (sliced views) """
+    row_size = max(1, int(np.prod(data.shape[1:])) * data.dtype.itemsize)
+    nb_rows = max(1, WRITE_CHUNK_SIZE // row_size)
+    for start, end in _get_chunk_bounds(lengths, nb_rows):
+        curr_lengths = np.asarray(lengths[start:end], dtype=np.int64)
+        curr_offsets = np.asarray(offsets[start:end], dtype=np.int64)
+        rank = np.arange(int(np.sum(curr_lengths))) - np.repeat(
+            np.cumsum(curr_lengths) - curr_lengths, curr_lengths)
+        yield data[np.repeat(curr_offsets, curr_lengths) + rank]
+
+
+def _write_chunks(fileobj, chunks):
+    """ Write blocks of an array to a (zip member) file object """
+    for chunk in chunks:
+        fileobj.write(memoryview(np.ascontiguousarray(chunk)).cast('B'))
+
+
+# Size of the blocks deflated independently when compressing in parallel
+COMPRESSION_BLOCK_SIZE = 4 * 1024 * 1024
+
+
+def _deflate_block(block, compresslevel=zlib.Z_DEFAULT_COMPRESSION):
+    """ Deflate a block as an independent piece of a raw deflate stream """
+    compressor = zlib.compressobj(compresslevel, zlib.DEFLATED,
+                                  -zlib.MAX_WBITS)
+    # A sync flush ends the block on a byte boundary, without the final
+    # bit, so that blocks can be concatenated
+    return compressor.compress(block) + compressor.flush(zlib.Z_SYNC_FLUSH)
+
+
+def _iter_blocks(chunks, block_size=COMPRESSION_BLOCK_SIZE):
+    """ Split blocks of an array (or bytes) into blocks of block_size """
+    for chunk in chunks:
+        if isinstance(chunk, np.ndarray):
+            chunk = np.ascontiguousarray(chunk)
+        chunk = memoryview(chunk).cast('B')
+        for pos in range(0, len(chunk), block_size):
+            yield chunk[pos:pos + block_size]
+
+
+def _write_member(zf, elem_filename, nbytes, chunks, compression_standard):
+    """ Write a member of a zip from blocks of data """
+    zip_info = zipfile.ZipInfo(elem_filename)
+    zip_info.compress_type = compression_standard
+    # Known in advance, allows zip64 for large members
+    zip_info.file_size = nbytes
+
+    with zf.open(zip_info, mode='w') as zf_member:
+        _write_chunks(zf_member, chunks)
+
+
+# Members (or their offset) larger than this use the zip64 extension
+ZIP64_LIMIT = (1 << 31) - 1
+
+
+class _ZipWriter():
+    """ Zip writer deflating the blocks of each member in parallel (by
+    nb_threads threads), as a single raw deflate stream. The crc and sizes
+    of each member are written in its local header once its data is
+    written (the file must be seekable) """
+
+    def __init__(self, filename, nb_threads=1):
+        self._file = open(filename, 'wb')
+        self._nb_threads = nb_threads
+        self._executor = ThreadPoolExecutor(max_workers=nb_threads)
+        self._entries = []
+        date_time = time.localtime(time.time())[0:6]
+        self._dos_date = (max(date_time[0] - 1980, 0) << 9) \
+            | (date_time[1] << 5) | date_time[2]
+        self._dos_time = (date_time[3] << 11) | (date_time[4] << 5) \
+            | (date_time[5] // 2)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        if exc_type is None:
+            self.close()
+        else:
+            self._executor.shutdown(cancel_futures=True)
+            self._file.close()
+
+    def _iter_deflated(self, chunks):
+        """ Yield the raw and deflated blocks of a member, in order """
+        pending = deque()
+        for block in _iter_blocks(chunks):
+            pending.append((block, self._executor.submit(_deflate_block,
+                                                         block)))
+            if len(pending) >= 2 * self._nb_threads:
+                block, future = pending.popleft()
+                yield block, future.result()
+        while pending:
+            block, future = pending.popleft()
+            yield block, future.result()
+        # Empty final block, terminates the deflate stream
+        yield b'', zlib.compressobj(zlib.Z_DEFAULT_COMPRESSION, zlib.DEFLATED,
+                                    -zlib.MAX_WBITS).flush(zlib.Z_FINISH)
+
+    def write_member(self, elem_filename, chunks,
+                     compression_standard=zipfile.ZIP_STORED, nbytes=0):
+        """ Write a member from blocks of data, nbytes (size of the data, or
+        an upper bound) decides if the zip64 extension is needed """
+        if compression_standard == zipfile.ZIP_DEFLATED:
+            blocks = self._iter_deflated(chunks)
+        elif compression_standard == zipfile.ZIP_STORED:
+            blocks = ((block, block) for block in _iter_blocks(chunks))
+        else:
+            raise ValueError('Unsupported compression.')
+
+        try:
+            name, flags = elem_filename.encode('ascii'), 0
+        except UnicodeEncodeError:
+            name, flags = elem_filename.encode('utf-8'), 0x800
+        zip64 = nbytes * 1.05 > ZIP64_LIMIT
+        version = 45 if zip64 else 20
+        extra = struct.pack('<2H2Q', 1, 16, 0, 0) if zip64 else b''
+
+        header_offset = self._file.tell()
+        self._file.write(struct.pack(
+            '<4s5H3L2H', b'PK\x03\x04', version, flags,
+            compression_standard, self._dos_time, self._dos_date, 0, 0, 0,
+            len(name), len(extra)) + name + extra)
+
+        crc, file_size, compress_size = 0, 0, 0
+        for raw, data in blocks:
+            crc = zlib.crc32(raw, crc)
+            file_size += len(raw)
+            compress_size += len(data)
+            self._file.write(data)
+        if not zip64 and max(file_size, compress_size) > ZIP64_LIMIT:
+            raise ValueError('Member larger than declared, zip64 needed.')
+
+        # Complete the local header
+        end = self._file.tell()
+        self._file.seek(header_offset + 14)
+        if zip64:
+            self._file.write(struct.pack('<3L', crc, 0xFFFFFFFF, 0xFFFFFFFF))
+            self._file.seek(header_offset + 30 + len(name) + 4)
+            self._file.write(struct.pack('<2Q', file_size, compress_size))
+        else:
+            self._file.write(struct.pack('<3L', crc, compress_size,
+                                         file_size))
+        self._file.seek(end)
+
+        self._entries.append((name, flags, compression_standard, crc,
+                              compress_size, file_size, header_offset))
+
+    def close(self):
+        """ Write the central directory and close the file """
+        self._executor.shutdown()
+        cd_offset = self._file.tell()
+        for name, flags, compression_standard, crc, compress_size, \
+                file_size, header_offset in self._entries:
+            zip64_fields = []
+            if file_size > ZIP64_LIMIT or compress_size > ZIP64_LIMIT:
+                zip64_fields.extend([file_size, compress_size])
+                file_size, compress_size = 0xFFFFFFFF, 0xFFFFFFFF
+            if header_offset > ZIP64_LIMIT:
+                zip64_fields.append(header_offset)
+                header_offset = 0xFFFFFFFF
+            extra = struct.pack('<2H{}Q'.format(len(zip64_fields)), 1,
+                                8 * len(zip64_fields), *zip64_fields) \
+                if zip64_fields else b''
+            version = 45 if zip64_fields else 20
+            # Made by unix (3), read and write permissions for the owner
+            self._file.write(struct.pack(
+                '<4s4B4HL2L5H2L', b'PK\x01\x02', version, 3, version, 0,
+                flags, compression_standard, self._dos_time, self._dos_date,
+                crc, compress_size, file_size, len(name), len(extra), 0, 0,
+                0, 0o600 << 16, header_offset) + name + extra)
+
+        cd_end = self._file.tell()
+        nb_entries, cd_size = len(self._entries), cd_end - cd_offset
+        if nb_entries > 0xFFFF or cd_offset > ZIP64_LIMIT \
+                or cd_size > ZIP64_LIMIT:
+            self._file.write(struct.pack(
+                '<4sQ2H2L4Q', b'PK\x06\x06', 44, 45, 45, 0, 0, nb_entries,
+                nb_entries, cd_size, cd_offset))
+            self._file.write(struct.pack('<4sLQL', b'PK\x06\x07', 0, cd_end,
+                                         1))
+            nb_entries = min(nb_entries, 0xFFFF)
+            cd_size = min(cd_size, 0xFFFFFFFF)
+            cd_offset = min(cd_offset, 0xFFFFFFFF)
+        self._file.write(struct.pack('<4s4H2LH', b'PK\x05\x06', 0, 0,
+                                     nb_entries, nb_entries, cd_size,
+                                     cd_offset, 0))
+        self._file.close()
+
+
+def _write_zip(filename, members, compression_standard, nb_threads=1,
+               stored=()):
+    """ Write members, as (name, number of bytes, generator of blocks), to
+    a zip. With ZIP_DEFLATED, blocks are compressed by nb_threads threads,
+    members listed in stored are never compressed """
+    if nb_threads > 1 and compression_standard == zipfile.ZIP_DEFLATED:
+        with _ZipWriter(filename, nb_threads=nb_threads) as zw:
+            for elem_filename, nbytes, chunks in members:
+                zw.write_member(elem_filename, chunks,
+                                zipfile.ZIP_STORED if elem_filename in stored
+                                else compression_standard, nbytes=nbytes)
+        return
+
+    with zipfile.ZipFile(filename, mode='w',
+                         compression=compression_standard) as zf:
+        for elem_filename, nbytes, chunks in members:
+            _write_member(zf, elem_filename, nbytes, chunks,
+                          zipfile.ZIP_STORED if elem_filename in stored
+                          else compression_standard)
+
+
+def _iter_row_blocks(chunks, block_size):
+    """ Regroup blocks of an array into blocks of exactly block_size rows
+    (except the last one) """
+    pending, nb_pending = [], 0
+    for chunk in chunks:
+        chunk = np.asarray(chunk)
+        pos = 0
+        while pos < len(chunk):
+            nb_rows = min(block_size - nb_pending, len(chunk) - pos)
+            pending.append(chunk[pos:pos + nb_rows])
+            nb_pending += nb_rows
+            pos += nb_rows
+            if nb_pending == block_size:
+                yield np.concatenate(pending)
+                pending, nb_pending = [], 0
+    if nb_pending:
+        yield np.concatenate(pending)
+
+
+def _compress_block(block, block_filter=None):
+    """ Filter and compress a block as an independent zlib stream """
+    return np.frombuffer(zlib.compress(_filter_block(block, block_filter)),
+                         dtype=np.uint8)
+
+
+def _iter_compressed_blocks(blocks, block_offsets, block_filter=None,
+                            nb_threads=1):
+    """ Yield the compressed blocks (by nb_threads threads), appending where
+    each of them ends to block_offsets """
+    def _record(compressed):
+        block_offsets.append(block_offsets[-1] + len(compressed))
+        return compressed
+
+    if nb_threads <= 1:
+        for block in blocks:
+            yield _record(_compress_block(block, block_filter))
+        return
+
+    with ThreadPoolExecutor(max_workers=nb_threads) as executor:
+        pending = deque()
+        for block in blocks:
+            pending.append(executor.submit(_compress_block, block,
+                                           block_filter))
+            if len(pending) >= 2 * nb_threads:
+                yield _record(pending.popleft().result())
+        while pending:
+            yield _record(pending.popleft().result())
+
+
+def _iter_block_table(block_offsets):
+    """ Yield the block offset table, once the blocks are written """
+    yield np.asarray(block_offsets, dtype=np.uint64)
+
+
+def _save_to_zip(filename, header, arrays, compression_standard,
+                 nb_threads=1):
+    """ Stream the header and arrays straight into the members of a zip """
+    header_json = json.dumps(header).encode()
+    # Chunked arrays are already compressed (by blocks)
+    _write_zip(filename,
+               [('header.json', len(header_json), [header_json])] + arrays,
+               compression_standard, nb_threads=nb_threads,
+               stored=header.get('CHUNKED', {}))
+
+
+def _save_to_directory(directory, header, arrays):
+    """ Stream the header and arrays straight into files of a folder """
+    os.mkdir(directory)
+    with open(os.path.join(directory, 'header.json'), 'w') as out_json:
+        json.dump(header, out_json)
+    for elem_filename, nbytes, chunks in arrays:
+        elem_filename = os.path.join(directory, elem_filename)
+        if not os.path.isdir(os.path.dirname(elem_filename)):
+            os.makedirs(os.path.dirname(elem_filename))
+        with open(elem_filename, 'wb') as f:
+            _write_chunks(f, chunks)
+
+
+def _get_tmp_filename(filename):
+    """ Temporary file (or folder) next to the destination, to be moved """
+    return os.path.join(os.path.dirname(os.path.abspath(filename)),
+                        '.{}.{}.tmp'.format(os.path.basename(filename),
+                                            os.getpid()))
+
+
+def save(trx, filename, compression_standard=zipfile.ZIP_STORED,
+         save_lengths=True, nb_threads=1, quantize_positions=None,
+         block_size=None, block_filter=None):
+    """ Save a TrxFile (compressed or not), lengths are persisted unless
+    save_lengths is False. Positions can be quantized (int16 or int32, with
+    a per-axis scale and offset) using quantize_positions
+
+    Each array is streamed, trimmed to its real size, from its memmap to
+    the zip member or file, without any temporary copy. With ZIP_DEFLATED,
+    blocks of the arrays are compressed by nb_threads threads
+
+    If block_size is provided, positions and dpv are stored as independently
+    compressed blocks of block_size vertices (optionally filtered with
+    'shuffle' or 'delta'), only the blocks that are accessed are decompressed
+    when loaded (the other members are better left as ZIP_STORED) """
     if os.path.splitext(filename)[1] and not \
             os.path.splitext(filename)[1] in ['.zip', '.trx']:
         raise ValueError('Unsupported extension.')
 
-    copy_trx = trx.deepcopy()
-    copy_trx.resize()
-
-    tmp_dir_name = copy_trx._uncompressed_folder_handle.name
-    if os.path.splitext(filename)[1] and \
-            os.path.splitext(filename)[1] in ['.zip', '.trx']:
-        zip_from_folder(tmp_dir_name, filename, compression_standard)
+    header, arrays = trx._get_arrays_to_save(
+        save_lengths=save_lengths, quantize_positions=quantize_positions,
+        block_size=block_size, block_filter=block_filter,
+        nb_threads=nb_threads)
+    _save_arrays(filename, header, arrays, compression_standard,
+                 nb_threads=nb_threads)
+
+
+def _save_arrays(filename, header, arrays, compression_standard,
+                 nb_threads=1):
+    """ Write the header and arrays to a zip or a folder, next to the
+    destination then moved, in case the destination is where the inputs
+    are mapped from """
+    filename = filename.rstrip(os.sep)
+    tmp_filename = _get_tmp_filename(filename)
+    if os.path.splitext(filename)[1] in ['.zip', '.trx']:
+        try:
+            _save_to_zip(tmp_filename, header, arrays, compression_standard,
+                         nb_threads=nb_threads)
+        except BaseException:
+            if os.path.isfile(tmp_filename):
+                os.remove(tmp_filename)
+            raise
+        os.replace(tmp_filename, filename)
     else:
+        try:
+            _save_to_directory(tmp_filename, header, arrays)
+        except BaseException:
+            if os.path.isdir(tmp_filename):
+                shutil.rmtree(tmp_filename)
+            raise
         if os.path.isdir(filename):
             shutil.rmtree(filename)
-        shutil.copytree(tmp_dir_name, filename)
-    copy_trx.close()
+        os.rename(tmp_filename, filename)
+
+
+def _rebase_chunks(chunks, dtype, shift=0):
+    """ Cast blocks of an array to dtype and shift their values """
+    for chunk in chunks:
+        chunk = np.asarray(chunk).astype(dtype, copy=False)
+        yield chunk + np.asarray(shift, dtype=dtype) if shift else chunk
+
+
+def concatenate_to_file(trx_list, filename, delete_dpv=False,
+                        delete_dps=False, delete_groups=False,
+                        check_space_attributes=True,
+                        compression_standard=zipfile.ZIP_STORED,
+                        save_lengths=True, nb_threads=1):
+    """ Concatenate multiple TrxFile (or filenames) directly into a zip or
+    a folder, without a temporary TrxFile
+
+    The arrays of the inputs are streamed by blocks with their offsets and
+    groups rebased, groups are merged (data_per_group and spatial indices
+    are not kept). Inputs uncompressed on disk are read from their memmaps,
+    compressed members are decompressed by blocks while they are written """
+    if os.path.splitext(filename)[1] and not \
+            os.path.splitext(filename)[1] in ['.zip', '.trx']:
+        raise ValueError('Unsupported extension.')
+
+    trx_list = [load(curr_trx, lazy_decompression=True)
+                if isinstance(curr_trx, str) else curr_trx
+                for curr_trx in trx_list]
+    trx_list = [curr_trx for curr_trx in trx_list
+                if curr_trx.header['NB_STREAMLINES'] > 0]
+    if len(trx_list) == 0:
+        raise ValueError('Inputs of concatenation were empty.')
+    _check_concatenate(trx_list, delete_dpv=delete_dpv, delete_dps=delete_dps,
+                       check_space_attributes=check_space_attributes)
+
+    # Arrays of every input, by name without extension (e.g dpv/fa)
+    all_arrays = []
+    strs_starts, pts_starts = [0], [0]
+    for curr_trx in trx_list:
+        curr_header, curr_arrays = curr_trx._get_arrays_to_save(
+            save_lengths=save_lengths)
+        strs_starts.append(strs_starts[-1] + curr_header['NB_STREAMLINES'])
+        pts_starts.append(pts_starts[-1] + curr_header['NB_VERTICES'])
+        curr_dict = {}
+        for elem_filename, nbytes, chunks in curr_arrays:
+            base, dim, ext = _split_ext_with_dimensionality(elem_filename)
+            key = os.path.join(os.path.dirname(elem_filename), base)
+            curr_dict[key] = (elem_filename, nbytes, chunks,
+                              np.dtype('bool' if ext == '.bit' else ext[1:]))
+        all_arrays.append(curr_dict)
+
+    # Fixed-size arrays must exist in all inputs, groups in at least one
+    # (the spatial indices are only valid for their own input)
+    keys = [key for key in all_arrays[0]
+            if not key.startswith(('groups', 'dpg', 'spatial_index',
+                                   'chunks'))
+            and all(key in curr_dict for curr_dict in all_arrays)]
+    if not delete_groups:
+        for curr_dict in all_arrays:
+            keys.extend([key for key in curr_dict
+                         if key.startswith('groups') and key not in keys])
+
+    header = _get_header_to_save(trx_list[0].header, pts_starts[-1],
+                                 strs_starts[-1])
+
+    arrays = []
+    for key in keys:
+        present = [(i, curr_dict[key]) for i, curr_dict
+                   in enumerate(all_arrays) if key in curr_dict]
+        # The first input sets the dtype (as with concatenate)
+        elem_filename, _, _, dtype = present[0][1]
+        if key.startswith('groups') and \
+                any(curr[3] != dtype for _, curr in present):
+            raise ValueError('Shared group key, has different dtype.')
+
+        # Groups stored as .bit (masks) must cover all the streamlines
+        if dtype == bool:
+            present = [(i, curr_dict[key]) if key in curr_dict else
+                       (i, (None, strs_starts[i+1] - strs_starts[i],
+                            [np.zeros(strs_starts[i+1] - strs_starts[i],
+                                      dtype=bool)], dtype))
+                       for i, curr_dict in enumerate(all_arrays)]
+
+        nbytes = 0
+        chunks_list = []
+        for i, (_, curr_nbytes, chunks, curr_dtype) in present:
+            nbytes += curr_nbytes // curr_dtype.itemsize * dtype.itemsize
+            if key == 'offsets':
+                shift = pts_starts[i]
+            elif key.startswith('groups') and dtype != bool:
+                shift = strs_starts[i]
+            else:
+                shift = 0
+            chunks_list.append(_rebase_chunks(chunks, dtype, shift))
+        arrays.append((elem_filename, nbytes,
+                       itertools.chain.from_iterable(chunks_list)))
+
+    _save_arrays(filename, header, arrays, compression_standard,
+                 nb_threads=nb_threads)
+
+
+def _iter_file_chunks(filename):
+    """ Yield the content of a file by blocks of WRITE_CHUNK_SIZE bytes """
+    with open(filename, 'rb') as f:
+        for chunk in iter(partial(f.read, WRITE_CHUNK_SIZE), b''):
+            yield chunk
 
 
 def zip_from_folder(directory, filename,
-                    compression_standard=zipfile.ZIP_STORED):
-    """ Utils function to zip on-disk memmaps """
+                    compression_standard=zipfile.ZIP_STORED, nb_threads=1):
+    """ Utils function to zip on-disk memmaps (with ZIP_DEFLATED, blocks of
+    the files are compressed by nb_threads threads) """
+    if nb_threads > 1 and compression_standard == zipfile.ZIP_DEFLATED:
+        arrays = []
+        for root, dirs, files in os.walk(directory):
+            for name in files:
+                tmp_filename = os.path.join(root, name)
+                arrays.append((tmp_filename.replace(directory+'/', ''),
+                               os.path.getsize(tmp_filename),
+                               _iter_file_chunks(tmp_filename)))
+        _write_zip(filename, arrays, compression_standard,
+                   nb_threads=nb_threads)
+        return
+
     with zipfile.ZipFile(filename, mode='w',
                          compression=compression_standard) as zf:
         for root, dirs, files in os.walk(directory):
@@ -381,6 +1496,314 @@ def zip_from_folder(directory, filename,
                 zf.write(tmp_filename, tmp_filename.replace(directory+'/', ''))
 
 
+def _get_trk_slices(names, nb_values, default_name):
+    """ Split the scalars/properties of a .trk into named slices """
+    slices = {}
+    cpt = 0
+    for encoded_name in names:
+        name, nb_values_name = decode_value_from_name(encoded_name)
+        if nb_values_name == 0:
+            continue
+        slices[name] = slice(cpt, cpt + nb_values_name)
+        cpt += nb_values_name
+
+    if cpt < nb_values:
+        slices[default_name] = slice(cpt, nb_values)
+
+    return slices
+
+
+def trk_to_trx(trk_filename, filename, cast_position=np.float16,
+               batch_size=100000, compression_standard=zipfile.ZIP_STORED):
+    """ Convert a .trk to a TrxFile on disk, streaming batches of
+    streamlines directly into memmaps (no full load in RAM) """
+    if os.path.splitext(filename)[1] and not \
+            os.path.splitext(filename)[1] in ['.zip', '.trx']:
+        raise ValueError('Unsupported extension.')
+    if not np.issubdtype(cast_position, np.floating):
+        logging.warning('Casting as {}, considering using a floating point '
+                        'dtype.'.format(cast_position))
+
+    header = nib.streamlines.load(trk_filename, lazy_load=True).header
+    nb_streamlines = int(header['nb_streamlines'])
+    n_scalars = int(header['nb_scalars_per_point'])
+    n_properties = int(header['nb_properties_per_streamline'])
+    lengths, index_bytes = get_index(trk_filename, header['hdr_size'],
+                                     nb_streamlines, n_scalars, n_properties)
+    nb_vertices = int(np.sum(lengths))
+
+    to_zip = os.path.splitext(filename)[1] in ['.zip', '.trx']
+    if to_zip:
+        tmp_dir = tempfile.TemporaryDirectory()
+        directory = tmp_dir.name
+    else:
+        if os.path.isdir(filename):
+            shutil.rmtree(filename)
+        os.mkdir(filename)
+        directory = filename
+
+    trx_header = {'DIMENSIONS': np.array(header['dimensions']).tolist(),
+                  'VOXEL_TO_RASMM': np.array(
+                      header['voxel_to_rasmm']).tolist(),
+                  'NB_VERTICES': nb_vertices,
+                  'NB_STREAMLINES': nb_streamlines}
+    with open(os.path.join(directory, 'header.json'), 'w') as out_json:
+        json.dump(trx_header, out_json)
+
+    positions_dtype = np.dtype(cast_position)
+    positions = _create_memmap(
+        os.path.join(directory, 'positions.3.{}'.format(positions_dtype.name)),
+        mode='w+', shape=(nb_vertices, 3), dtype=positions_dtype)
+    offsets = _create_memmap(os.path.join(directory, 'offsets.uint64'),
+                             mode='w+', shape=(nb_streamlines,),
+                             dtype=np.uint64)
+    offsets[:] = np.cumsum(lengths) - lengths
+
+    # TrackVis scalars and properties are float32, named in the header
+    data_arrays = []
+    for folder, slices, size in \
+            [('dpv', _get_trk_slices(header['scalar_name'], n_scalars,
+                                     'scalars'), nb_vertices),
+             ('dps', _get_trk_slices(header['property_name'], n_properties,
+                                     'properties'), nb_streamlines)]:
+        if len(slices):
+            os.mkdir(os.path.join(directory, folder))
+        for key, slice_obj in slices.items():
+            dim = slice_obj.stop - slice_obj.start
+            shape = (size, dim)
+            name = '{}.float32'.format(key) if dim == 1 \
+                else '{}.{}.float32'.format(key, dim)
+            data_arrays.append((folder, slice_obj, _create_memmap(
+                os.path.join(directory, folder, name), mode='w+',
+                shape=shape, dtype=np.float32)))
+
+    affine = get_affine_trackvis_to_rasmm(header)
+    pts_start = 0
+    for strs_start in range(0, nb_streamlines, batch_size):
+        strs_end = min(strs_start + batch_size, nb_streamlines)
+        points, scalars, properties = read_trk_records(
+            trk_filename, strs_start, strs_end, lengths, index_bytes,
+            n_scalars=n_scalars, n_properties=n_properties)
+        pts_end = pts_start + len(points)
+
+        positions[pts_start:pts_end] = apply_affine(affine, points)
+        for folder, slice_obj, arr in data_arrays:
+            if folder == 'dpv':
+                arr[pts_start:pts_end] = scalars[:, slice_obj]
+            else:
+                arr[strs_start:strs_end] = properties[:, slice_obj]
+        pts_start = pts_end
+
+    # Flush and release the memmaps before zipping
+    del positions, offsets, data_arrays
+
+    if to_zip:
+        zip_from_folder(directory, filename, compression_standard)
+        tmp_dir.cleanup()
+
+
+def _get_flat_data(sequence):
+    """ Flat data and lengths of an ArraySequence or a list of arrays """
+    if isinstance(sequence, ArraySequence):
+        return sequence.get_data(), np.asarray(sequence._lengths)
+
+    sequence = [np.asarray(item) for item in sequence]
+    lengths = np.array([len(item) for item in sequence], dtype=np.uint32)
+    if len(sequence) == 0:
+        return np.zeros((0, 3)), lengths
+    return np.concatenate(sequence), lengths
+
+
+class TrxWriter():
+    """ Write a TrxFile on disk from batches of streamlines (with their dpv
+    and dps), appended to the files of a temporary folder. Only a batch is
+    in RAM at once, the TrxFile is finalized (zipped or moved) on close
+
+    with TrxWriter('tractogram.trx', reference='t1.nii.gz') as writer:
+        for streamlines, dpv, dps in batches:
+            writer.write(streamlines, data_per_vertex=dpv,
+                         data_per_streamline=dps)
+    """
+
+    def __init__(self, filename, reference=None, cast_position=np.float16,
+                 compression_standard=zipfile.ZIP_STORED, nb_threads=1):
+        """ Initialize an empty TrxFile at its temporary location """
+        if os.path.splitext(filename)[1] and not \
+                os.path.splitext(filename)[1] in ['.zip', '.trx']:
+            raise ValueError('Unsupported extension.')
+        if not np.issubdtype(cast_position, np.floating):
+            logging.warning('Casting as {}, considering using a floating '
+                            'point dtype.'.format(cast_position))
+
+        if reference is not None:
+            affine, dimensions, _, _ = get_reference_info(reference)
+        else:
+            logging.debug('No reference provided, using blank space '
+                          'attributes, please update them later.')
+            affine = np.eye(4).astype(np.float32)
+            dimensions = np.array([1, 1, 1], dtype=np.uint16)
+        self.header = {'DIMENSIONS': np.asarray(dimensions).tolist(),
+                       'VOXEL_TO_RASMM': np.asarray(affine).tolist(),
+                       'NB_VERTICES': 0,
+                       'NB_STREAMLINES': 0}
+
+        self.filename = filename.rstrip(os.sep)
+        self._positions_dtype = np.dtype(cast_position)
+        self._compression_standard = compression_standard
+        self._nb_threads = nb_threads
+        self._to_zip = os.path.splitext(filename)[1] in ['.zip', '.trx']
+        if self._to_zip:
+            self._tmp_dir = tempfile.TemporaryDirectory()
+            self._directory = self._tmp_dir.name
+        else:
+            self._tmp_dir = None
+            self._directory = _get_tmp_filename(self.filename)
+            if os.path.isdir(self._directory):
+                shutil.rmtree(self._directory)
+            os.mkdir(self._directory)
+
+        # Opened files, with their dtype and dimensionality
+        self._files = {}
+        self._dpv_keys = None
+        self._dps_keys = None
+        self._append([('positions', np.zeros((0, 3)), self._positions_dtype),
+                      ('offsets', np.zeros((0,)), np.uint64),
+                      ('lengths', np.zeros((0,)), np.uint32)])
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        if exc_type is None:
+            self.close()
+        else:
+            self.abort()
+
+    def _append(self, arrays):
+        """ Append arrays (name, data, dtype) to their files, all arrays are
+        verified before writing anything """
+        for name, arr, dtype in arrays:
+            if name in self._files and \
+                    arr.shape[1:] != self._files[name][2]:
+                raise ValueError('Wrong {} dimensionality.'.format(name))
+
+        for name, arr, dtype in arrays:
+            if name not in self._files:
+                dtype = np.dtype(arr.dtype if dtype is None else dtype)
+                filename = _generate_filename_from_data(
+                    np.zeros((0,) + arr.shape[1:], dtype=dtype),
+                    os.path.join(self._directory, name))
+                os.makedirs(os.path.dirname(filename), exist_ok=True)
+                self._files[name] = (open(filename, 'wb'), dtype,
+                                     arr.shape[1:])
+            fileobj, dtype, _ = self._files[name]
+            _write_chunks(fileobj, _iter_chunks(arr.astype(dtype,
+                                                           copy=False)))
+
+    def write(self, streamlines, data_per_vertex=None,
+              data_per_streamline=None):
+        """ Append a batch of streamlines (ArraySequence or list of arrays),
+        the dpv (same structure or flat arrays) and dps must be given for
+        every batch with the same keys """
+        data_per_vertex = {} if data_per_vertex is None else data_per_vertex
+        data_per_streamline = {} if data_per_streamline is None \
+            else data_per_streamline
+        if self._files is None:
+            raise ValueError('TrxWriter is closed.')
+        if self._dpv_keys is None:
+            self._dpv_keys = set(data_per_vertex.keys())
+            self._dps_keys = set(data_per_streamline.keys())
+        if set(data_per_vertex.keys()) != self._dpv_keys:
+            raise ValueError('Batches must be sharing identical dpv keys.')
+        if set(data_per_streamline.keys()) != self._dps_keys:
+            raise ValueError('Batches must be sharing identical dps keys.')
+
+        positions, lengths = _get_flat_data(streamlines)
+        if positions.ndim != 2 or positions.shape[1] != 3:
+            raise ValueError('Wrong positions dimensionality.')
+        lengths = lengths.astype(np.uint64)
+        offsets = np.cumsum(lengths) - lengths \
+            + np.uint64(self.header['NB_VERTICES'])
+        arrays = [('positions', positions, None),
+                  ('offsets', offsets, None),
+                  ('lengths', lengths, None)]
+
+        for dpv_key, data in data_per_vertex.items():
+            if not isinstance(data, np.ndarray):
+                data, dpv_lengths = _get_flat_data(data)
+                if not np.array_equal(dpv_lengths, lengths):
+                    raise ValueError('{} (dpv) does not match the '
+                                     'streamlines.'.format(dpv_key))
+            if len(data) != len(positions):
+                raise ValueError('Wrong {} (dpv) size.'.format(dpv_key))
+            arrays.append((os.path.join('dpv', dpv_key), data, None))
+
+        for dps_key, data in data_per_streamline.items():
+            data = np.asarray(data)
+            if len(data) != len(lengths):
+                raise ValueError('Wrong {} (dps) size.'.format(dps_key))
+            arrays.append((os.path.join('dps', dps_key), data, None))
+
+        self._append(arrays)
+        self.header['NB_VERTICES'] += len(positions)
+        self.header['NB_STREAMLINES'] += len(lengths)
+
+    def _close_files(self):
+        for fileobj, _, _ in self._files.values():
+            fileobj.close()
+        self._files = None
+
+    def close(self):
+        """ Write the header and move (or zip) the TrxFile to its
+        destination """
+        if self._files is None:
+            return
+        self._close_files()
+        with open(os.path.join(self._directory, 'header.json'),
+                  'w') as out_json:
+            json.dump(self.header, out_json)
+
+        if self._to_zip:
+            tmp_filename = _get_tmp_filename(self.filename)
+            try:
+                zip_from_folder(self._directory, tmp_filename,
+                                self._compression_standard,
+                                nb_threads=self._nb_threads)
+            except BaseException:
+                if os.path.isfile(tmp_filename):
+                    os.remove(tmp_filename)
+                raise
+            finally:
+                self._tmp_dir.cleanup()
+            os.replace(tmp_filename, self.filename)
+        else:
+            if os.path.isdir(self.filename):
+                shutil.rmtree(self.filename)
+            os.rename(self._directory, self.filename)
+
+    def abort(self):
+        """ Discard everything written so far """
+        if self._files is None:
+            return
+        self._close_files()
+        if self._to_zip:
+            self._tmp_dir.cleanup()
+        else:
+            shutil.rmtree(self._directory)
+
+
+# Reserved dps of the per-streamline summaries (see compute_summaries)
+SUMMARY_KEYS = {'summary_bbox_min': 3, 'summary_bbox_max': 3,
+                'summary_start': 3, 'summary_end': 3,
+                'summary_length': 1, 'summary_centroid': 3}
+
+# Reductions of dpv to dps (see TrxFile.reduce_dpv)
+DPV_REDUCTIONS = ['mean', 'min', 'max', 'sum', 'std', 'percentile']
+
+# Operations of the group expressions (see TrxFile.get_groups_bitmap)
+GROUP_OPERATIONS = ['union', 'intersection', 'difference', 'complement']
+
+
 class TrxFile():
     """ Core class of the TrxFile """
 
@@ -415,6 +1838,11 @@ class TrxFile():
             self.data_per_vertex = {}
             self.data_per_group = {}
             self._uncompressed_folder_handle = None
+            # Bitmaps of groups and of group expressions (memoized)
+            self._group_bitmaps = {}
+            self._group_expressions = {}
+            # Streamlines by brick of voxels (see build_spatial_index)
+            self.spatial_index = {}
 
             nb_vertices = 0
             nb_streamlines = 0
@@ -502,6 +1930,8 @@ class TrxFile():
 
         tmp_header['VOXEL_TO_RASMM'] = tmp_header['VOXEL_TO_RASMM'].tolist()
         tmp_header['DIMENSIONS'] = tmp_header['DIMENSIONS'].tolist()
+        if not self.spatial_index or not self._copy_safe:
+            tmp_header.pop('SPATIAL_INDEX_BRICK_SIZE', None)
 
         # tofile() alway write in C-order
         if not self._copy_safe:
@@ -568,11 +1998,156 @@ class TrxFile():
                                           dpg_key))
                 to_dump.tofile(dpg_filename)
 
+        if self.spatial_index and self._copy_safe:
+            os.mkdir(os.path.join(tmp_dir.name, 'spatial_index/'))
+            for key in ['offsets', 'streamlines']:
+                to_dump = self.spatial_index[key]
+                spatial_filename = _generate_filename_from_data(
+                    to_dump, os.path.join(tmp_dir.name, 'spatial_index/',
+                                          key))
+                to_dump.tofile(spatial_filename)
+
         copy_trx = load_from_directory(tmp_dir.name)
         copy_trx._uncompressed_folder_handle = tmp_dir
 
         return copy_trx
 
+    def _get_arrays_to_save(self, save_lengths=True, quantize_positions=None,
+                            block_size=None, block_filter=None,
+                            nb_threads=1):
+        """ List the arrays of the TrxFile, trimmed to their real size, as
+        (relative filename, number of bytes, generator of blocks) with the
+        matching header (preallocation and sliced views are supported)
+
+        Positions are encoded as quantize_positions (int16 or int32), with
+        the scale and offset in the header, if provided
+
+        Positions and dpv are compressed by blocks of block_size vertices
+        (by nb_threads threads), followed by their block offset table, if
+        provided (the number of bytes is then an upper bound) """
+        if block_size is not None and (int(block_size) < 1 or
+                                       block_filter not in BLOCK_FILTERS):
+            raise ValueError('Invalid block size or filter.')
+        if self._copy_safe:
+            strs_end, pts_end = self._get_real_len()
+            lengths = self.streamlines._lengths[0:strs_end]
+            offsets = self.streamlines._offsets[0:strs_end]
+        else:
+            strs_end = len(self.streamlines)
+            lengths = self.streamlines._lengths
+            pts_end = int(np.sum(lengths))
+            offsets = (np.cumsum(lengths, dtype=np.uint64)
+                       - np.asarray(lengths, dtype=np.uint64)).astype(
+                self.streamlines._offsets.dtype)
+
+        header = _get_header_to_save(self.header, pts_end, strs_end)
+
+        arrays = []
+
+        def _add(elem_filename, arr, nb_rows, chunks=None):
+            """ Declare an array (by default, its first nb_rows) """
+            row_size = int(np.prod(arr.shape[1:])) * arr.dtype.itemsize
+            if chunks is None:
+                chunks = _iter_chunks(arr, 0, nb_rows)
+            arrays.append((_generate_filename_from_data(arr, elem_filename),
+                           nb_rows * row_size, chunks))
+
+        # Per-vertex arrays are gathered from sliced views
+        def _get_per_vertex_chunks(data):
+            if self._copy_safe:
+                return _iter_chunks(data, 0, pts_end)
+            return _iter_gathered_chunks(data, self.streamlines._offsets,
+                                         lengths)
+
+        def _add_per_vertex(elem_filename, data, chunks=None):
+            if chunks is None:
+                chunks = _get_per_vertex_chunks(data)
+            if block_size is None:
+                _add(elem_filename, data, pts_end, chunks=chunks)
+                return
+
+            elem_filename = _generate_filename_from_data(data, elem_filename)
+            row_size = int(np.prod(data.shape[1:]))
+            header['CHUNKED'][elem_filename] = {
+                'SIZE': pts_end * row_size, 'BLOCK_SIZE': int(block_size),
+                'FILTER': block_filter}
+            block_offsets = [0]
+            arrays.append((elem_filename,
+                           pts_end * row_size * data.dtype.itemsize,
+                           _iter_compressed_blocks(
+                               _iter_row_blocks(chunks, int(block_size)),
+                               block_offsets, block_filter=block_filter,
+                               nb_threads=nb_threads)))
+            nb_blocks = -(-pts_end // int(block_size))
+            arrays.append((_get_block_table_filename(elem_filename),
+                           (nb_blocks + 1) * 8,
+                           _iter_block_table(block_offsets)))
+
+        if block_size is not None:
+            header['CHUNKED'] = {}
+
+        # Compressed members not loaded yet (lazy decompression) are
+        # streamed from the zip, rather than decompressed whole
+        positions = _peek_data(self.streamlines)
+        if quantize_positions is None:
+            _add_per_vertex('positions', positions)
+        else:
+            dtype = np.dtype(quantize_positions)
+            if dtype not in [np.dtype(np.int16), np.dtype(np.int32)]:
+                raise ValueError('Positions can only be quantized as int16 '
+                                 'or int32.')
+            scale, offset = _get_quantization(
+                _get_per_vertex_chunks(positions), dtype)
+            header['POSITIONS_SCALE'] = scale.tolist()
+            header['POSITIONS_OFFSET'] = offset.tolist()
+            _add_per_vertex('positions', np.zeros((0, 3), dtype=dtype),
+                            chunks=_quantize_chunks(
+                                _get_per_vertex_chunks(positions),
+                                scale, offset, dtype))
+        _add('offsets', offsets, strs_end)
+        if save_lengths:
+            _add('lengths', np.asarray(lengths).astype(np.uint32), strs_end)
+
+        for dpv_key in self.data_per_vertex.keys():
+            _add_per_vertex(os.path.join('dpv', dpv_key), _peek_data(
+                _peek_item(self.data_per_vertex, dpv_key)))
+
+        for dps_key in self.data_per_streamline.keys():
+            _add(os.path.join('dps', dps_key),
+                 _peek_item(self.data_per_streamline, dps_key),
+                 strs_end)
+
+        # The spatial index is only valid for the TrxFile it was built on
+        if self.spatial_index and self._copy_safe:
+            header['SPATIAL_INDEX_BRICK_SIZE'] = int(
+                self.header['SPATIAL_INDEX_BRICK_SIZE'])
+            for key in ['offsets', 'streamlines']:
+                _add(os.path.join('spatial_index', key),
+                     self.spatial_index[key], len(self.spatial_index[key]))
+
+        for group_key in self.groups.keys():
+            group = _peek_item(self.groups, group_key)
+            if not isinstance(group, _ZipMemberLoader) or \
+                    strs_end != self.header['NB_STREAMLINES']:
+                # Remove groups indices of unused (preallocated) streamlines
+                group = _trim_group(self.groups[group_key], strs_end)
+            _add(os.path.join('groups', group_key), group, len(group))
+
+            if group_key not in self.data_per_group:
+                continue
+            for dpg_key in self.data_per_group[group_key].keys():
+                dpg = self.data_per_group[group_key][dpg_key]
+                _add(os.path.join('dpg', group_key, dpg_key), dpg, len(dpg))
+
+        return header, arrays
+
+    def validate_lengths(self):
+        """ Check that the lengths (persisted or not) fit the offsets """
+        lengths = _compute_lengths(self.streamlines._offsets,
+                                   self.header['NB_VERTICES'])
+        if not np.array_equal(lengths, self.streamlines._lengths):
+            raise ValueError('Lengths do not match the offsets.')
+
     def _get_real_len(self):
         """ Get the real size of data (ignoring zeros of preallocation) """
         if len(self.streamlines._lengths) == 0:
@@ -729,11 +2304,26 @@ class TrxFile():
         return trx
 
     def _create_trx_from_pointer(header, dict_pointer_size,
-                                 root_zip=None, root=None):
-        """ After reading the structure of a zip/folder, create a TrxFile """
+                                 root_zip=None, root=None, compressed=None,
+                                 scratch_dir=None):
+        """ After reading the structure of a zip/folder, create a TrxFile
+
+        Members of the zip listed in compressed are declared as loaders,
+        decompressed on first access (offsets are needed right away)
+
+        Arrays compressed by blocks (CHUNKED in the header) are read through
+        their block offset table, one block at a time """
         # TODO support empty positions, using optional tag?
         trx = TrxFile()
         trx.header = header
+        # Once loaded, chunked arrays behave as any other array
+        chunked = trx.header.pop('CHUNKED', {})
+        lengths = None
+        if compressed:
+            trx.data_per_streamline = _LazyDict()
+            trx.data_per_vertex = _LazyDict()
+            trx.groups = _LazyDict()
+            trx.data_per_group = _LazyDict()
         positions, offsets = None, None
         for elem_filename in dict_pointer_size.keys():
             if root_zip:
@@ -741,6 +2331,38 @@ class TrxFile():
             else:
                 filename = elem_filename
 
+            def _open_chunked_array(relative_filename, shape, dtype):
+                table_filename = _get_block_table_filename(relative_filename)
+                if root is not None:
+                    table_filename = os.path.join(root, table_filename)
+                if table_filename not in dict_pointer_size:
+                    raise ValueError('Missing block offset table.')
+                table_adress, table_size = dict_pointer_size[table_filename]
+                if compressed and table_filename in compressed:
+                    block_offsets = _decompress_zip_member(
+                        root_zip, table_filename, (table_size,), np.uint64)
+                else:
+                    block_offsets = _create_memmap(
+                        root_zip if root_zip else table_filename, mode='r',
+                        offset=table_adress, shape=(table_size,),
+                        dtype=np.uint64)
+                info = chunked[relative_filename]
+                return _ChunkedArray(filename, mem_adress, shape, dtype,
+                                     block_offsets, info['BLOCK_SIZE'],
+                                     block_filter=info['FILTER'])
+
+            def _open_array(shape, dtype):
+                relative_filename = elem_filename if root is None \
+                    else os.path.relpath(elem_filename, root)
+                if relative_filename in chunked:
+                    return _open_chunked_array(relative_filename, shape,
+                                               dtype)
+                if compressed and elem_filename in compressed:
+                    return _ZipMemberLoader(root_zip, elem_filename, shape,
+                                            dtype, scratch_dir=scratch_dir)
+                return _create_memmap(filename, mode='r+', offset=mem_adress,
+                                      shape=shape, dtype=dtype)
+
             folder = os.path.dirname(elem_filename)
             base, dim, ext = _split_ext_with_dimensionality(elem_filename)
             if ext == '.bit':
@@ -754,19 +2376,22 @@ class TrxFile():
             if base == 'positions' and folder == '':
                 if size != trx.header['NB_VERTICES']*3 or dim != 3:
                     raise ValueError('Wrong data size/dimensionality.')
-                positions = _create_memmap(filename, mode='r+',
-                                           offset=mem_adress,
-                                           shape=(
-                                               trx.header['NB_VERTICES'], 3),
-                                           dtype=ext[1:])
+                positions = _open_array((trx.header['NB_VERTICES'], 3),
+                                        ext[1:])
             elif base == 'offsets' and folder == '':
                 if size != trx.header['NB_STREAMLINES'] or dim != 1:
                     raise ValueError('Wrong offsets size/dimensionality.')
-                offsets = _create_memmap(filename, mode='r+',
-                                         offset=mem_adress,
-                                         shape=(trx.header['NB_STREAMLINES'],),
-                                         dtype=ext[1:])
-                lengths = _compute_lengths(offsets, trx.header['NB_VERTICES'])
+                offsets = _open_array((trx.header['NB_STREAMLINES'],),
+                                      ext[1:])
+                if callable(offsets):
+                    offsets = offsets()
+            elif base == 'lengths' and folder == '':
+                if size != trx.header['NB_STREAMLINES'] or dim != 1:
+                    raise ValueError('Wrong lengths size/dimensionality.')
+                lengths = _open_array((trx.header['NB_STREAMLINES'],),
+                                      ext[1:])
+                if callable(lengths):
+                    lengths = lengths()
             elif folder == 'dps':
                 nb_scalar = size / trx.header['NB_STREAMLINES']
                 if not nb_scalar.is_integer() or nb_scalar != dim:
@@ -774,9 +2399,7 @@ class TrxFile():
                 else:
                     shape = (trx.header['NB_STREAMLINES'], int(nb_scalar))
 
-                trx.data_per_streamline[base] = _create_memmap(
-                    filename, mode='r+', offset=mem_adress,
-                    shape=shape, dtype=ext[1:])
+                trx.data_per_streamline[base] = _open_array(shape, ext[1:])
             elif folder == 'dpv':
                 nb_scalar = size / trx.header['NB_VERTICES']
                 if not nb_scalar.is_integer() or nb_scalar != dim:
@@ -784,9 +2407,7 @@ class TrxFile():
                 else:
                     shape = (trx.header['NB_VERTICES'], int(nb_scalar))
 
-                trx.data_per_vertex[base] = _create_memmap(
-                    filename, mode='r+', offset=mem_adress,
-                    shape=shape, dtype=ext[1:])
+                trx.data_per_vertex[base] = _open_array(shape, ext[1:])
             elif folder.startswith('dpg'):
                 if int(size) != dim:
                     raise ValueError('Wrong dpg size/dimensionality.')
@@ -797,10 +2418,16 @@ class TrxFile():
                 data_name = os.path.basename(base)
                 sub_folder = os.path.basename(folder)
                 if sub_folder not in trx.data_per_group:
-                    trx.data_per_group[sub_folder] = {}
-                trx.data_per_group[sub_folder][data_name] = _create_memmap(
-                    filename, mode='r+', offset=mem_adress,
-                    shape=shape, dtype=ext[1:])
+                    trx.data_per_group[sub_folder] = _LazyDict() \
+                        if compressed else {}
+                trx.data_per_group[sub_folder][data_name] = _open_array(
+                    shape, ext[1:])
+            elif folder == 'spatial_index':
+                if dim != 1 or 'SPATIAL_INDEX_BRICK_SIZE' not in trx.header:
+                    raise ValueError('Wrong spatial index.')
+                spatial_array = _open_array((int(size),), ext[1:])
+                trx.spatial_index[base] = spatial_array() \
+                    if callable(spatial_array) else spatial_array
             elif folder == 'groups':
                 # Groups are simply indices, nothing else
                 # TODO Crash if not uint?
@@ -808,30 +2435,103 @@ class TrxFile():
                     raise ValueError('Wrong group dimensionality.')
                 else:
                     shape = (int(size),)
-                trx.groups[base] = _create_memmap(filename, mode='r+',
-                                                  offset=mem_adress,
-                                                  shape=shape,
-                                                  dtype=ext[1:])
+                trx.groups[base] = _open_array(shape, ext[1:])
+            elif folder.split(os.sep)[0] == 'chunks':
+                # Block offset tables are opened with their array
+                continue
             else:
                 logging.error('{} is not part of a valid structure.'.format(
                     elem_filename))
 
         # All essential array must be declared
         if positions is not None and offsets is not None:
-            trx.streamlines._data = positions
+            # Persisted lengths avoid computing them from the offsets
+            if lengths is None:
+                lengths = _compute_lengths(offsets,
+                                           trx.header['NB_VERTICES'])
+            # Quantized positions are decoded when accessed, by rows
+            if 'POSITIONS_SCALE' in trx.header:
+                positions = _QuantizedArray(positions,
+                                            trx.header.pop('POSITIONS_SCALE'),
+                                            trx.header.pop('POSITIONS_OFFSET'))
+            if callable(positions):
+                trx.streamlines = _LazyArraySequence(data_loader=positions)
+            else:
+                trx.streamlines._data = positions
             trx.streamlines._offsets = offsets
             trx.streamlines._lengths = lengths
         else:
             raise ValueError('Missing essential data.')
 
+        if trx.spatial_index:
+            grid = _get_brick_grid(trx.header['DIMENSIONS'],
+                                   trx.header['SPATIAL_INDEX_BRICK_SIZE'])
+            if len(trx.spatial_index.get('offsets', [])) != np.prod(grid) + 1 \
+                    or 'streamlines' not in trx.spatial_index:
+                raise ValueError('Wrong spatial index size.')
+
         for dpv_key in trx.data_per_vertex:
-            tmp = trx.data_per_vertex[dpv_key]
-            trx.data_per_vertex[dpv_key] = ArraySequence()
-            trx.data_per_vertex[dpv_key]._data = tmp
+            tmp = _peek_item(trx.data_per_vertex, dpv_key)
+            if callable(tmp):
+                trx.data_per_vertex[dpv_key] = _LazyArraySequence(
+                    data_loader=tmp)
+            else:
+                trx.data_per_vertex[dpv_key] = ArraySequence()
+                trx.data_per_vertex[dpv_key]._data = tmp
             trx.data_per_vertex[dpv_key]._offsets = offsets
             trx.data_per_vertex[dpv_key]._lengths = lengths
         return trx
 
+    def _copy_groups_from(self, trx, strs_end, delete_dpg=False):
+        """ Copy the groups (up to strs_end) and dpg of another TrxFile in
+        the temporary folder """
+        tmp_dir = self._uncompressed_folder_handle.name
+        if len(trx.groups.keys()) > 0:
+            os.mkdir(os.path.join(tmp_dir, 'groups/'))
+
+        for group_key in trx.groups.keys():
+            group_dtype = trx.groups[group_key].dtype
+            group_name = os.path.join(tmp_dir, 'groups/',
+                                      '{}.{}'.format(group_key,
+                                                     group_dtype.name))
+            ori_len = len(trx.groups[group_key])
+
+            # Remove groups indices if resizing down
+            tmp = _trim_group(trx.groups[group_key], strs_end)
+            self.groups[group_key] = _create_memmap(group_name, mode='w+',
+                                                    shape=(len(tmp),),
+                                                    dtype=group_dtype)
+            logging.debug('{} group went from {} items to {}'.format(group_key,
+                                                                     ori_len,
+                                                                     len(tmp)))
+            self.groups[group_key][:] = tmp
+
+        if delete_dpg:
+            return
+
+        if len(trx.data_per_group.keys()) > 0:
+            os.mkdir(os.path.join(tmp_dir, 'dpg/'))
+        for group_key in trx.data_per_group:
+            if not os.path.isdir(os.path.join(tmp_dir, 'dpg/', group_key)):
+                os.mkdir(os.path.join(tmp_dir, 'dpg/', group_key))
+            if group_key not in self.data_per_group:
+                self.data_per_group[group_key] = {}
+
+            for dpg_key in trx.data_per_group[group_key].keys():
+                dpg_dtype = trx.data_per_group[group_key][dpg_key].dtype
+                dpg_filename = _generate_filename_from_data(
+                    trx.data_per_group[group_key][dpg_key],
+                    os.path.join(tmp_dir, 'dpg/', group_key, dpg_key))
+
+                shape = trx.data_per_group[group_key][dpg_key].shape
+                if dpg_key not in self.data_per_group[group_key]:
+                    self.data_per_group[group_key][dpg_key] = {}
+                self.data_per_group[group_key][dpg_key] = _create_memmap(
+                    dpg_filename, mode='w+', shape=shape, dtype=dpg_dtype)
+
+                self.data_per_group[group_key][dpg_key][:
+                                                        ] = trx.data_per_group[group_key][dpg_key]
+
     def resize(self, nb_streamlines=None, nb_vertices=None, delete_dpg=False):
         """ Remove the ununsed portion of preallocated memmaps """
         if not self._copy_safe:
@@ -860,6 +2560,8 @@ class TrxFile():
             logging.debug('TrxFile of the right size, no resizing.')
             return
 
+        self._drop_spatial_index()
+        self.clear_group_cache()
         trx = self._initialize_empty_trx(nb_streamlines, nb_vertices,
                                          init_as=self)
 
@@ -876,60 +2578,86 @@ class TrxFile():
         else:
             trx._copy_fixed_arrays_from(self)
 
-        tmp_dir = trx._uncompressed_folder_handle.name
-        if len(self.groups.keys()) > 0:
-            os.mkdir(os.path.join(tmp_dir, 'groups/'))
-
-        for group_key in self.groups.keys():
-            group_dtype = self.groups[group_key].dtype
-            group_name = os.path.join(tmp_dir, 'groups/',
-                                      '{}.{}'.format(group_key,
-                                                     group_dtype.name))
-            ori_len = len(self.groups[group_key])
-
-            # Remove groups indices if resizing down
-            tmp = self.groups[group_key][self.groups[group_key] < strs_end]
-            trx.groups[group_key] = _create_memmap(group_name, mode='w+',
-                                                   shape=(len(tmp),),
-                                                   dtype=group_dtype)
-            logging.debug('{} group went from {} items to {}'.format(group_key,
-                                                                     ori_len,
-                                                                     len(tmp)))
-            trx.groups[group_key][:] = tmp
+        trx._copy_groups_from(self, strs_end, delete_dpg=delete_dpg)
 
-        if delete_dpg:
-            self.close()
-            self.__dict__ = trx.__dict__
-            return
-
-        if len(self.data_per_group.keys()) > 0:
-            os.mkdir(os.path.join(tmp_dir, 'dpg/'))
-        for group_key in self.data_per_group:
-            if not os.path.isdir(os.path.join(tmp_dir, 'dpg/', group_key)):
-                os.mkdir(os.path.join(tmp_dir, 'dpg/', group_key))
-            if group_key not in trx.data_per_group:
-                trx.data_per_group[group_key] = {}
-
-            for dpg_key in self.data_per_group[group_key].keys():
-                dpg_dtype = self.data_per_group[group_key][dpg_key].dtype
-                dpg_filename = _generate_filename_from_data(
-                    self.data_per_group[group_key][dpg_key],
-                    os.path.join(tmp_dir, 'dpg/', group_key, dpg_key))
+        self.close()
+        self.__dict__ = trx.__dict__
 
-                shape = self.data_per_group[group_key][dpg_key].shape
-                if dpg_key not in trx.data_per_group[group_key]:
-                    trx.data_per_group[group_key][dpg_key] = {}
-                trx.data_per_group[group_key][dpg_key] = _create_memmap(
-                    dpg_filename, mode='w+', shape=shape, dtype=dpg_dtype)
+    def _grow(self, nb_streamlines, nb_vertices):
+        """ Increase the capacity of the fixed-size arrays by extending the
+        memmaps of the temporary folder in place (no copy of the data),
+        return False when it is not possible (or not allowed by the OS) """
+        if not self._copy_safe or self._uncompressed_folder_handle is None:
+            return False
+        tmp_dir = self._uncompressed_folder_handle.name
 
-                trx.data_per_group[group_key][dpg_key][:
-                                                       ] = self.data_per_group[group_key][dpg_key]
+        to_grow = [('positions', self.streamlines._data, nb_vertices),
+                   ('offsets', self.streamlines._offsets, nb_streamlines)]
+        for dpv_key in self.data_per_vertex.keys():
+            to_grow.append((os.path.join('dpv', dpv_key),
+                            self.data_per_vertex[dpv_key]._data, nb_vertices))
+        for dps_key in self.data_per_streamline.keys():
+            to_grow.append((os.path.join('dps', dps_key),
+                            self.data_per_streamline[dps_key], nb_streamlines))
+
+        # Only memmaps spanning a whole file of the temporary folder
+        filenames = []
+        for name, arr, _ in to_grow:
+            filename = _generate_filename_from_data(
+                arr, os.path.join(tmp_dir, name))
+            if not isinstance(arr, np.memmap) or arr.offset != 0 \
+                    or arr.filename != os.path.abspath(filename):
+                return False
+            filenames.append(filename)
+
+        try:
+            for (_, arr, nb_rows), filename in zip(to_grow, filenames):
+                arr.flush()
+                with open(filename, 'r+b') as f:
+                    f.truncate(nb_rows * arr[0:1].nbytes)
+        except OSError:
+            # Growing a mapped file is not allowed everywhere
+            return False
+
+        grown = [_create_memmap(filename, mode='r+',
+                                shape=(nb_rows,) + arr.shape[1:],
+                                dtype=arr.dtype)
+                 for (_, arr, nb_rows), filename in zip(to_grow, filenames)]
+        lengths = np.zeros((nb_streamlines,),
+                           dtype=self.streamlines._lengths.dtype)
+        lengths[0:len(self.streamlines._lengths)] = self.streamlines._lengths
+
+        self.streamlines._data = grown[0]
+        self.streamlines._offsets = grown[1]
+        self.streamlines._lengths = lengths
+        grown = grown[2:]
+        for dpv_key in self.data_per_vertex.keys():
+            self.data_per_vertex[dpv_key]._data = grown.pop(0)
+            self.data_per_vertex[dpv_key]._offsets = self.streamlines._offsets
+            self.data_per_vertex[dpv_key]._lengths = self.streamlines._lengths
+        for dps_key in self.data_per_streamline.keys():
+            self.data_per_streamline[dps_key] = grown.pop(0)
 
-        self.close()
-        self.__dict__ = trx.__dict__
+        self.clear_group_cache()
+        logging.debug('Growing capacity to {} streamlines and {} '
+                      'vertices.'.format(nb_streamlines, nb_vertices))
+        self.header['NB_STREAMLINES'] = nb_streamlines
+        self.header['NB_VERTICES'] = nb_vertices
+        return True
 
-    def append(self, trx, extra_buffer=0):
-        """ Append a TrxFile to another (support buffer) """
+    def append(self, trx, extra_buffer=0, strs_growth=2.0, pts_growth=2.0):
+        """ Append a TrxFile to another (support buffer)
+
+        When the capacity is exceeded, it grows geometrically (strs_growth
+        and pts_growth for streamlines and vertices) with extra_buffer more
+        streamlines (and as many streamlines of average length). Memmaps are
+        extended in place when possible, the unused capacity is trimmed by
+        save() or resize() """
+        if strs_growth < 1 or pts_growth < 1:
+            raise ValueError('Growth factors must be at least 1.')
+        self._drop_spatial_index()
+        # Groups are modified in place
+        self.clear_group_cache()
         strs_end, pts_end = self._get_real_len()
 
         nb_streamlines = strs_end + trx.header['NB_STREAMLINES']
@@ -937,16 +2665,525 @@ class TrxFile():
 
         if self.header['NB_STREAMLINES'] < nb_streamlines \
                 or self.header['NB_VERTICES'] < nb_vertices:
-            self.resize(nb_streamlines=nb_streamlines+extra_buffer,
-                        nb_vertices=nb_vertices+extra_buffer*100)
+            mean_length = nb_vertices / max(nb_streamlines, 1)
+            nb_streamlines = max(nb_streamlines,
+                                 int(self.header['NB_STREAMLINES'] *
+                                     strs_growth)) + extra_buffer
+            nb_vertices = max(nb_vertices,
+                              int(self.header['NB_VERTICES'] *
+                                  pts_growth)) \
+                + int(np.ceil(extra_buffer * mean_length))
+            if not self._grow(nb_streamlines, nb_vertices):
+                # Copy to a new temporary folder, can be grown from now on
+                self.resize(nb_streamlines=nb_streamlines,
+                            nb_vertices=nb_vertices)
         _ = concatenate([self, trx], preallocation=True,
                         delete_groups=True)
 
+    def _drop_spatial_index(self):
+        """ The spatial index is invalidated by changes to the streamlines """
+        self.spatial_index = {}
+        self.header.pop('SPATIAL_INDEX_BRICK_SIZE', None)
+
+    def build_spatial_index(self, brick_size=4, batch_size=100000):
+        """ Index the streamlines by the bricks (cubes of brick_size voxels)
+        their vertices are in, using VOXEL_TO_RASMM and DIMENSIONS. The
+        index is saved with the TrxFile and used by query_mask/query_sphere
+
+        The streamlines are read by batches of batch_size, the index is
+        stored as offsets (per brick, plus the total) into the streamlines
+        ids of all bricks """
+        if brick_size < 1:
+            raise ValueError('The brick size must be strictly positive.')
+        affine = self.header['VOXEL_TO_RASMM']
+        dimensions = self.header['DIMENSIONS']
+        grid = _get_brick_grid(dimensions, brick_size)
+        strs_end = self._get_real_len()[0] if self._copy_safe else len(self)
+
+        # Unique (brick, streamline) pairs, sorted within each batch
+        pairs = [np.zeros((0,), dtype=np.int64)]
+        for start in range(0, strs_end, batch_size):
+            end = min(start + batch_size, strs_end)
+            streamlines = self.streamlines[start:end]
+            bricks = _get_bricks(streamlines.get_data(), affine, dimensions,
+                                 brick_size)
+            ids = np.repeat(np.arange(start, end, dtype=np.int64),
+                            np.asarray(streamlines._lengths, dtype=np.int64))
+            pairs.append(np.unique(bricks * strs_end + ids))
+        pairs = np.concatenate(pairs)
+        bricks, ids = np.divmod(pairs, max(strs_end, 1))
+
+        # Batches are in streamlines order, keep it within bricks
+        order = np.argsort(bricks, kind='stable')
+        offsets = np.zeros((int(np.prod(grid)) + 1,), dtype=np.uint64)
+        offsets[1:] = np.cumsum(np.bincount(bricks,
+                                            minlength=int(np.prod(grid))))
+
+        self.spatial_index = {'offsets': offsets,
+                              'streamlines': ids[order].astype(np.uint32)}
+        self.header['SPATIAL_INDEX_BRICK_SIZE'] = int(brick_size)
+        logging.debug('Spatial index of {} bricks, {} entries.'.format(
+            len(offsets) - 1, len(pairs)))
+
+    def _get_spatial_candidates(self, bricks):
+        """ Streamlines (sorted, unique) with vertices in any of the bricks,
+        the spatial index is built if needed """
+        if not self.spatial_index:
+            self.build_spatial_index()
+        offsets = self.spatial_index['offsets']
+        starts = np.asarray(offsets[bricks], dtype=np.int64)
+        lengths = np.asarray(offsets[bricks + 1], dtype=np.int64) - starts
+        rank = np.arange(int(np.sum(lengths))) - np.repeat(
+            np.cumsum(lengths) - lengths, lengths)
+
+        return np.unique(self.spatial_index['streamlines'][
+            np.repeat(starts, lengths) + rank])
+
+    def _filter_candidates(self, candidates, vertex_filter):
+        """ Candidates with at least one vertex passing vertex_filter """
+        if len(candidates) == 0:
+            return candidates.astype(np.uint32)
+        streamlines = self.streamlines[candidates]
+        lengths = np.asarray(streamlines._lengths, dtype=np.int64)
+        passing = vertex_filter(streamlines.get_data())
+        keep = np.logical_or.reduceat(passing, np.cumsum(lengths) - lengths)
+
+        return candidates[keep].astype(np.uint32)
+
+    def query_mask(self, mask, exact=True):
+        """ Indices (sorted) of the streamlines with vertices in a mask (of
+        the DIMENSIONS of the TrxFile). Only the streamlines of the bricks
+        of the mask are read, exact=False returns these candidates """
+        mask = np.asarray(mask, dtype=bool)
+        dimensions = self.header['DIMENSIONS']
+        if mask.shape != tuple(dimensions):
+            raise ValueError('The mask must have the dimensions of the '
+                             'TrxFile.')
+        if not self.spatial_index:
+            self.build_spatial_index()
+        brick_size = int(self.header['SPATIAL_INDEX_BRICK_SIZE'])
+
+        bricks = np.unique(np.ravel_multi_index(
+            tuple((np.argwhere(mask) // brick_size).T),
+            _get_brick_grid(dimensions, brick_size)))
+        candidates = self._get_spatial_candidates(bricks)
+        if not exact:
+            return candidates.astype(np.uint32)
+
+        def _in_mask(positions):
+            voxels = _get_voxels(positions, self.header['VOXEL_TO_RASMM'])
+            inside = np.all((voxels >= 0) & (voxels < dimensions), axis=1)
+            passing = np.zeros((len(voxels),), dtype=bool)
+            passing[inside] = mask[tuple(voxels[inside].T)]
+            return passing
+
+        return self._filter_candidates(candidates, _in_mask)
+
+    def query_sphere(self, center, radius, exact=True):
+        """ Indices (sorted) of the streamlines with vertices in a sphere
+        (center and radius in RASMM). Only the streamlines of the bricks
+        around the sphere are read, exact=False returns these candidates """
+        center = np.asarray(center, dtype=np.float64)
+        if not self.spatial_index:
+            self.build_spatial_index()
+        brick_size = int(self.header['SPATIAL_INDEX_BRICK_SIZE'])
+        dimensions = np.asarray(self.header['DIMENSIONS'], dtype=np.int64)
+
+        # Bricks of the bounding box of the sphere, clipped to the volume
+        corners = center + radius * np.array(
+            [[x, y, z] for x in [-1, 1] for y in [-1, 1] for z in [-1, 1]])
+        voxels = np.clip(_get_voxels(corners, self.header['VOXEL_TO_RASMM']),
+                         0, dimensions - 1)
+        brick_min = np.min(voxels, axis=0) // brick_size
+        brick_max = np.max(voxels, axis=0) // brick_size
+        brick_coords = np.meshgrid(*[np.arange(brick_min[i], brick_max[i] + 1)
+                                     for i in range(3)], indexing='ij')
+        bricks = np.ravel_multi_index(
+            tuple(coords.ravel() for coords in brick_coords),
+            _get_brick_grid(dimensions, brick_size))
+        candidates = self._get_spatial_candidates(bricks)
+        if not exact:
+            return candidates.astype(np.uint32)
+
+        def _in_sphere(positions):
+            return np.sum((positions - center) ** 2, axis=1) <= radius ** 2
+
+        return self._filter_candidates(candidates, _in_sphere)
+
+    def _create_dps_memmap(self, key, dim, dtype):
+        """ New dps memmap (not yet added) of dim values per streamline, in
+        the temporary folder of the TrxFile """
+        if self._uncompressed_folder_handle is None:
+            self._uncompressed_folder_handle = tempfile.TemporaryDirectory()
+        tmp_dir = self._uncompressed_folder_handle.name
+        if not os.path.isdir(os.path.join(tmp_dir, 'dps')):
+            os.mkdir(os.path.join(tmp_dir, 'dps'))
+
+        nb_streamlines = len(self.streamlines._lengths)
+        shape = (nb_streamlines,) if dim == 1 else (nb_streamlines, dim)
+        filename = _generate_filename_from_data(
+            np.zeros((0,) + shape[1:], dtype=dtype),
+            os.path.join(tmp_dir, 'dps', key))
+        if os.path.isfile(filename):
+            os.remove(filename)
+        return _create_memmap(filename, mode='w+', shape=shape, dtype=dtype)
+
+    def compute_summaries(self, batch_size=100000):
+        """ Compute the bounding box, first and last points, arc length and
+        centroid (RASMM) of every streamline, by batches of batch_size, as
+        reserved dps (SUMMARY_KEYS) saved with the TrxFile """
+        strs_end = self._get_real_len()[0] if self._copy_safe else len(self)
+        summaries = {key: self._create_dps_memmap(key, dim, np.float32)
+                     for key, dim in SUMMARY_KEYS.items()}
+
+        for start in range(0, strs_end, batch_size):
+            end = min(start + batch_size, strs_end)
+            streamlines = self.streamlines[start:end]
+            lengths = np.asarray(streamlines._lengths, dtype=np.int64)
+            data = streamlines.get_data().astype(np.float64)
+
+            # Empty streamlines are left to NaN
+            valid = np.flatnonzero(lengths > 0)
+            firsts = (np.cumsum(lengths) - lengths)[valid]
+            lasts = firsts + lengths[valid] - 1
+            for key in SUMMARY_KEYS:
+                summaries[key][start:end] = np.nan
+            if len(valid) == 0:
+                continue
+
+            summaries['summary_bbox_min'][start + valid] = \
+                np.minimum.reduceat(data, firsts)
+            summaries['summary_bbox_max'][start + valid] = \
+                np.maximum.reduceat(data, firsts)
+            summaries['summary_start'][start + valid] = data[firsts]
+            summaries['summary_end'][start + valid] = data[lasts]
+            summaries['summary_centroid'][start + valid] = \
+                np.add.reduceat(data, firsts) / lengths[valid, None]
+
+            # Segments between streamlines cancel out in the difference
+            arc_length = np.zeros((len(data),))
+            arc_length[1:] = np.cumsum(np.linalg.norm(np.diff(data, axis=0),
+                                                      axis=1))
+            summaries['summary_length'][start + valid] = \
+                arc_length[lasts] - arc_length[firsts]
+
+        self.data_per_streamline.update(summaries)
+
+    def query_summaries(self, min_length=None, max_length=None, box=None,
+                        endpoints_mask=None, both_endpoints=False):
+        """ Indices (sorted) of the streamlines matching all the criteria,
+        using only the summaries (computed if needed, see
+        compute_summaries). Arc length in mm, box as ((min x, y, z),
+        (max x, y, z)) in RASMM containing the whole streamline and
+        endpoints_mask (of the DIMENSIONS) containing one (or both)
+        endpoints of the streamline """
+        if any(key not in self.data_per_streamline for key in SUMMARY_KEYS):
+            self.compute_summaries()
+        strs_end = self._get_real_len()[0] if self._copy_safe else len(self)
+
+        def _get(key):
+            summary = np.asarray(self.data_per_streamline[key][0:strs_end])
+            return summary.reshape((strs_end, SUMMARY_KEYS[key]))
+
+        keep = np.ones((strs_end,), dtype=bool)
+        if min_length is not None:
+            keep &= _get('summary_length')[:, 0] >= min_length
+        if max_length is not None:
+            keep &= _get('summary_length')[:, 0] <= max_length
+        if box is not None:
+            keep &= np.all(_get('summary_bbox_min') >= box[0], axis=1)
+            keep &= np.all(_get('summary_bbox_max') <= box[1], axis=1)
+        if endpoints_mask is not None:
+            endpoints_mask = np.asarray(endpoints_mask, dtype=bool)
+            dimensions = self.header['DIMENSIONS']
+            if endpoints_mask.shape != tuple(dimensions):
+                raise ValueError('The mask must have the dimensions of the '
+                                 'TrxFile.')
+            in_mask = []
+            for key in ['summary_start', 'summary_end']:
+                points = _get(key)
+                valid = np.all(np.isfinite(points), axis=1)
+                voxels = _get_voxels(np.where(valid[:, None], points, 0),
+                                     self.header['VOXEL_TO_RASMM'])
+                inside = valid & np.all((voxels >= 0) &
+                                        (voxels < dimensions), axis=1)
+                curr_in_mask = np.zeros((strs_end,), dtype=bool)
+                curr_in_mask[inside] = endpoints_mask[tuple(voxels[inside].T)]
+                in_mask.append(curr_in_mask)
+            keep &= (in_mask[0] & in_mask[1]) if both_endpoints \
+                else (in_mask[0] | in_mask[1])
+
+        return np.flatnonzero(keep).astype(np.uint32)
+
+    def reduce_dpv(self, dpv_key, reduction='mean', dps_key=None,
+                   percentile=50, chunk_size=1000000, nb_threads=1):
+        """ Reduce a dpv (or 'positions') to a dps per streamline, reduction
+        is mean, min, max, sum, std or percentile. The dpv is read by chunks
+        of whole streamlines (about chunk_size vertices), reduced with
+        segmented kernels, by nb_threads threads. The result (float32, NaN
+        for empty streamlines) is added as dps_key (by default
+        dpv_key_reduction) and returned """
+        if reduction not in DPV_REDUCTIONS:
+            raise ValueError('Unknown reduction: {}'.format(reduction))
+        if dpv_key == 'positions':
+            sequence = self.streamlines
+        elif dpv_key in self.data_per_vertex:
+            sequence = self.data_per_vertex[dpv_key]
+        else:
+            raise ValueError('{} is not a dpv key.'.format(dpv_key))
+        if dps_key is None:
+            dps_key = '{}_{}'.format(dpv_key, reduction)
+
+        strs_end = self._get_real_len()[0] if self._copy_safe else len(self)
+        dim = int(np.prod(sequence._data.shape[1:]))
+        result = self._create_dps_memmap(dps_key, dim, np.float32)
+        result = result.reshape((len(result), dim))
+
+        def _reduce_chunk(bounds):
+            start, end = bounds
+            chunk = sequence[start:end]
+            lengths = np.asarray(chunk._lengths, dtype=np.int64)
+            data = chunk.get_data().astype(np.float64).reshape((-1, dim))
+            result[start:end] = np.nan
+
+            # Empty streamlines have no segment
+            valid = np.flatnonzero(lengths > 0)
+            if len(valid) == 0:
+                return
+            firsts = (np.cumsum(lengths) - lengths)[valid]
+            lengths = lengths[valid, None]
+
+            if reduction == 'min':
+                values = np.minimum.reduceat(data, firsts)
+            elif reduction == 'max':
+                values = np.maximum.reduceat(data, firsts)
+            elif reduction == 'sum':
+                values = np.add.reduceat(data, firsts)
+            elif reduction == 'mean':
+                values = np.add.reduceat(data, firsts) / lengths
+            elif reduction == 'std':
+                means = np.add.reduceat(data, firsts) / lengths
+                deviations = (data - np.repeat(means, lengths[:, 0],
+                                               axis=0)) ** 2
+                values = np.sqrt(np.add.reduceat(deviations, firsts) /
+                                 lengths)
+            else:
+                # Sorted within each streamline, then interpolated (linear)
+                ids = np.repeat(np.arange(len(valid)), lengths[:, 0])
+                position = (lengths[:, 0] - 1) * percentile / 100.0
+                lower = np.floor(position).astype(np.int64)
+                upper = np.ceil(position).astype(np.int64)
+                weight = (position - lower)[:, None]
+                values = np.empty((len(valid), dim))
+                for i in range(dim):
+                    sorted_data = data[np.lexsort((data[:, i], ids)), i]
+                    values[:, i] = sorted_data[firsts + lower] * \
+                        (1 - weight[:, 0]) + \
+                        sorted_data[firsts + upper] * weight[:, 0]
+            result[start + valid] = values
+
+        bounds = _get_chunk_bounds(
+            np.asarray(self.streamlines._lengths[0:strs_end]), chunk_size)
+        if nb_threads > 1:
+            with ThreadPoolExecutor(max_workers=nb_threads) as executor:
+                list(executor.map(_reduce_chunk, bounds))
+        else:
+            for curr_bounds in bounds:
+                _reduce_chunk(curr_bounds)
+
+        self.data_per_streamline[dps_key] = result.reshape(
+            (len(result),)) if dim == 1 else result
+        return self.data_per_streamline[dps_key]
+
+    def resample(self, nb_points, chunk_size=1000000):
+        """ New TrxFile with every streamline resampled to nb_points points
+        equally spaced along its arc length (dpv are interpolated the same
+        way, dps and groups are copied, summaries are computed again). The
+        streamlines are read by chunks
+        of whole streamlines (about chunk_size vertices) and written into
+        the preallocated memmaps of the new TrxFile """
+        if nb_points < 2:
+            raise ValueError('Resampling requires at least 2 points.')
+        strs_end = self._get_real_len()[0] if self._copy_safe else len(self)
+        lengths = np.asarray(self.streamlines._lengths[0:strs_end],
+                             dtype=np.int64)
+
+        # Empty streamlines stay empty
+        new_lengths = np.where(lengths > 0, nb_points, 0)
+        new_offsets = np.cumsum(new_lengths) - new_lengths
+        trx = self._initialize_empty_trx(strs_end, int(np.sum(new_lengths)),
+                                         init_as=self)
+        trx.streamlines._offsets[:] = new_offsets
+        trx.streamlines._lengths[:] = new_lengths
+        for dps_key in self.data_per_streamline.keys():
+            # Summaries do not describe the resampled streamlines
+            if dps_key in SUMMARY_KEYS:
+                continue
+            trx.data_per_streamline[dps_key][:] = \
+                self.data_per_streamline[dps_key][0:strs_end]
+        trx._copy_groups_from(self, strs_end)
+
+        sequences = [(self.streamlines, trx.streamlines._data)]
+        for dpv_key in self.data_per_vertex.keys():
+            sequences.append((self.data_per_vertex[dpv_key],
+                              trx.data_per_vertex[dpv_key]._data))
+
+        ratios = np.linspace(0, 1, nb_points)
+        for start, end in _get_chunk_bounds(lengths, chunk_size):
+            chunk = self.streamlines[start:end]
+            curr_lengths = lengths[start:end]
+            valid = np.flatnonzero(curr_lengths > 0)
+            if len(valid) == 0:
+                continue
+            data = chunk.get_data().astype(np.float64)
+            firsts = (np.cumsum(curr_lengths) - curr_lengths)[valid]
+            lasts = firsts + curr_lengths[valid] - 1
+
+            # Arc length along the chunk, flat between streamlines
+            segments = np.linalg.norm(np.diff(data, axis=0), axis=1)
+            segments[firsts[1:] - 1] = 0
+            arc_length = np.zeros((len(data),))
+            arc_length[1:] = np.cumsum(segments)
+
+            # Segment of each new point and its position within it
+            targets = (arc_length[firsts, None] + ratios *
+                       (arc_length[lasts] - arc_length[firsts])[:, None])
+            lower = np.searchsorted(arc_length, targets.ravel(),
+                                    side='right') - 1
+            lower = np.clip(lower, np.repeat(firsts, nb_points),
+                            np.repeat(np.maximum(lasts - 1, firsts),
+                                      nb_points))
+            upper = np.minimum(lower + 1, np.repeat(lasts, nb_points))
+            span = arc_length[upper] - arc_length[lower]
+            weights = np.divide(targets.ravel() - arc_length[lower], span,
+                                out=np.zeros_like(span), where=span > 0)
+            weights = np.clip(weights, 0, 1)[:, None]
+
+            pts_start = int(new_offsets[start + valid[0]])
+            pts_end = pts_start + len(valid) * nb_points
+            for sequence, new_data in sequences:
+                curr_data = data if sequence is self.streamlines else \
+                    sequence[start:end].get_data().astype(np.float64)
+                curr_data = curr_data.reshape((len(data), -1))
+                values = curr_data[lower] * (1 - weights) + \
+                    curr_data[upper] * weights
+                if not np.issubdtype(new_data.dtype, np.floating):
+                    values = np.round(values)
+                new_data[pts_start:pts_end] = values.reshape(
+                    (-1,) + new_data.shape[1:]).astype(new_data.dtype)
+
+        if any(key in self.data_per_streamline for key in SUMMARY_KEYS):
+            trx.compute_summaries()
+
+        return trx
+
     def get_group(self, key, keep_group=True, copy_safe=False):
-        return self.select(self.groups[key],
+        group = self.groups[key]
+        if group.dtype == bool:
+            group = np.flatnonzero(group)
+        return self.select(group,
                            keep_group=keep_group,
                            copy_safe=copy_safe)
 
+    def get_group_bitmap(self, key):
+        """ Membership of the streamlines to a group as a bitmap (one bit
+        per streamline), built on first use and cached (as long as the group
+        and the number of streamlines are unchanged) """
+        group = self.groups[key]
+        cached = self._group_bitmaps.get(key)
+        if cached is not None and cached[0] is group \
+                and cached[1] == len(self):
+            return cached[2]
+
+        bitmap = group_to_bitmap(group, len(self))
+        self._group_bitmaps[key] = (group, len(self), bitmap)
+        return bitmap
+
+    @ staticmethod
+    def _normalize_group_expression(expression):
+        """ Validate a group expression, operands of commutative operations
+        are sorted so that equivalent sub-expressions share their memo """
+        if isinstance(expression, str):
+            return expression
+        if not isinstance(expression, (tuple, list)) or len(expression) < 2:
+            raise ValueError('Invalid group expression: {}'.format(expression))
+
+        operation = expression[0]
+        operands = tuple(TrxFile._normalize_group_expression(operand)
+                         for operand in expression[1:])
+        if operation not in GROUP_OPERATIONS:
+            raise ValueError('Unknown group operation: {}'.format(operation))
+        if operation == 'complement' and len(operands) != 1:
+            raise ValueError('Complement takes a single operand.')
+        if operation in ['union', 'intersection']:
+            operands = tuple(sorted(set(operands), key=repr))
+
+        return (operation,) + operands
+
+    def _evaluate_group_expression(self, expression):
+        """ Bitmap of a (normalized) group expression, memoized as long as
+        the groups it uses are unchanged """
+        if isinstance(expression, str):
+            return self.get_group_bitmap(expression), (expression,)
+
+        cached = self._group_expressions.get(expression)
+        if cached is not None and \
+                all(self.get_group_bitmap(key) is bitmap
+                    for key, bitmap in cached[0].items()):
+            return cached[1], tuple(cached[0].keys())
+
+        operation = expression[0]
+        bitmaps, keys = [], []
+        for operand in expression[1:]:
+            bitmap, operand_keys = self._evaluate_group_expression(operand)
+            bitmaps.append(bitmap)
+            keys.extend(operand_keys)
+
+        if operation == 'union':
+            result = reduce(np.bitwise_or, bitmaps)
+        elif operation == 'intersection':
+            result = reduce(np.bitwise_and, bitmaps)
+        elif operation == 'difference':
+            result = bitmaps[0] & ~reduce(np.bitwise_or, bitmaps[1:]) \
+                if len(bitmaps) > 1 else bitmaps[0]
+        else:
+            result = bitmap_complement(bitmaps[0], len(self))
+
+        self._group_expressions[expression] = (
+            {key: self.get_group_bitmap(key) for key in keys}, result)
+        return result, tuple(set(keys))
+
+    def get_groups_bitmap(self, expression):
+        """ Bitmap of a group expression, either a group key or a tuple
+        (operation, operand, ...) with nested expressions as operands, e.g
+        ('difference', ('union', 'AF_L', 'AF_R'), ('complement', 'CST')).
+        Operations are union, intersection, difference and complement """
+        expression = self._normalize_group_expression(expression)
+        return self._evaluate_group_expression(expression)[0]
+
+    def get_groups_indices(self, expression):
+        """ Indices (sorted) of the streamlines of a group expression """
+        return bitmap_to_group(self.get_groups_bitmap(expression),
+                               len(self)).astype(np.uint32)
+
+    def select_groups(self, expression, keep_group=True, copy_safe=False):
+        """ Get the streamlines of a group expression (see select) """
+        return self.select(self.get_groups_indices(expression),
+                           keep_group=keep_group, copy_safe=copy_safe)
+
+    def clear_group_cache(self):
+        """ Release the bitmaps of groups and group expressions (required
+        after modifying a group in place) """
+        self._group_bitmaps = {}
+        self._group_expressions = {}
+
+    def get_group_mask(self, key):
+        """ Membership of the streamlines to a group as a boolean mask, can
+        be set as the group itself (saved as a .bit array) """
+        mask = np.zeros(len(self), dtype=bool)
+        mask[bitmap_to_group(self.get_group_bitmap(key), len(self))] = True
+        return mask
+
     def select(self, indices, keep_group=True, copy_safe=False):
         """ Get a subset of items, always vertices to the same memmaps """
         indices = np.array(indices, dtype=np.uint32)
@@ -954,6 +3191,7 @@ class TrxFile():
         new_trx = TrxFile()
         new_trx._copy_safe = copy_safe
         new_trx.header = deepcopy(self.header)
+        new_trx.header.pop('SPATIAL_INDEX_BRICK_SIZE', None)
 
         if isinstance(indices, np.ndarray) and len(indices) == 0:
             # Even while empty, basic dtype and header must be coherent
@@ -988,18 +3226,14 @@ class TrxFile():
                             'items.')
             for group_key in self.groups.keys():
                 # Keep the group indices even when fancy slicing
-                index = np.argsort(indices)
-                sorted_x = indices[index]
-                sorted_index = np.searchsorted(
-                    sorted_x, self.groups[group_key])
-                yindex = np.take(index, sorted_index, mode="clip")
-                mask = indices[yindex] != self.groups[group_key]
-                intersect = yindex[~mask]
-
-                if len(intersect) == 0:
+                member = bitmap_contains(self.get_group_bitmap(group_key),
+                                         indices)
+                if not np.any(member):
                     continue
 
-                new_trx.groups[group_key] = intersect
+                group = self.groups[group_key]
+                new_trx.groups[group_key] = member if group.dtype == bool \
+                    else np.flatnonzero(member).astype(group.dtype)
                 if group_key in self.data_per_group:
                     for dpg_key in self.data_per_group[group_key].keys():
                         if group_key not in new_trx.data_per_group: